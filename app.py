@@ -1,14 +1,20 @@
+import os
+
 import nltk
 import requests
 
-from flask import Flask
+from flask import Flask, Response
 from flask.globals import request
 from flask_cors import CORS
 
 import settings
 
+from models import crud
 from models.database import session
-from services import text_processing, embeddings
+from services import embeddings, ingestion
+from services.context import ContextAssembler
+from services.filters import SearchFilter
+from utils import admission, metrics
 from utils.logging import logger
 
 
@@ -21,7 +27,11 @@ nltk.download("punkt_tab")
 nltk.download("omw-1.4")
 
 embedding = embeddings.Embeddings(session=session)
-wordnet_syn = embeddings.WordnetSyn(lang="por")
+wordnet_syn = embeddings.WordnetSyn(lang="por", preload=False)
+context_assembler = ContextAssembler(embedder=embedding)
+ollama_session = requests.Session()
+llm_admission = admission.AdmissionController()
+ingestion_worker = ingestion.IngestionWorker(session=session, embedder=embedding)
 # faiss_index = retrieval.FAISSIndex(session=session, embedder=embedding)
 # graph = retrieval.Graph(session, embedder=embedding)
 
@@ -30,12 +40,21 @@ def _setup():
     from models import database
 
     database.Base.metadata.create_all(bind=database.engine)
-    data = text_processing.parse_pdfs(session)
+    database.migrate()
+
+    if settings.LEXICAL_BACKEND == "fts5":
+        database.create_fts_index()
 
-    for key in data.keys():
-        embedding.process_data(data[key])
+    # New PDFs are embedded by the background worker, the server starts
+    # answering with the current corpus right away
+    if settings.INGEST_AT_STARTUP:
+        ingestion.submit_directory(session)
 
+    ingestion_worker.refresh()
     wordnet_syn._precompute_mapping()
+
+    if settings.INGEST_WORKER_AUTOSTART:
+        ingestion_worker.start()
     # faiss_index.build_index()
     # graph.build_graph_network()
 
@@ -43,37 +62,188 @@ def _setup():
 _setup()
 
 
-@app.route("/question", methods=["POST"])
-def question() -> dict:
-    query = request.json.get("query")
+@app.teardown_appcontext
+def remove_session(exception=None) -> None:
+    session.remove()
 
-    if not query:
-        return {}
-
-    prompt = f"Pergunta: {query}"
-
-    context = embedding.retrieve(query, top_k=5, rerank=True)
-    # context = faiss_index.search(query, top_k=20, rerank=True)
-    # context = graph.retrieve(query)
 
-    for row in context:
-        print(f"\n{row.get('content')} - {row.get('cosine_similarity')}\n\n")
-        prompt += f"\n\n[CONTEXTO]: {row['content']}\nFonte: {row['name']}"
-
-    logger.info(f"[Query consolidada]: {prompt}")
+def build_payload(
+    query: str, blocks: list[dict], conversation_context: list[int] | None = None
+) -> dict:
+    # Everything that doesn't depend on the request comes first, so Ollama can
+    # reuse the cached prefix instead of prefilling it again on every request
+    prompt_parts = [settings.OLLAMA_INSTRUCTION_PREFIX]
+    prompt_parts.extend(context_assembler.render_block(block) for block in blocks)
+    prompt_parts.append(f"Pergunta: {query}")
 
     payload = {
         "model": settings.OLLAMA_MODEL,
         "system": settings.OLLAMA_SYSTEM_PROMPT,
-        "prompt": prompt,
+        "prompt": "\n\n".join(prompt_parts),
         "options": settings.OLLAMA_PARAMETERS,
+        "keep_alive": settings.OLLAMA_KEEP_ALIVE,
         "stream": False,
     }
 
-    logger.info(f"[Payload enviado]: {payload}")
+    if conversation_context:
+        payload["context"] = conversation_context
+
+    return payload
+
 
-    response = requests.post(url=settings.OLLAMA_ENDPOINT, json=payload)
-    response_text = response.json()["response"]
-    print(response_text)
+def _rejected(exc: admission.Rejected) -> tuple[dict, int, dict]:
+    logger.warning(f"request rejected ({exc.status}): {exc.reason}")
+
+    return {"error": exc.reason}, exc.status, exc.headers
+
+
+def generate(payload: dict) -> dict:
+    """
+    Calls Ollama, raising a requests exception for anything but an answer:
+    refused or dropped connections, timeouts and error responses.
+    """
+    with llm_admission.admit(), metrics.timer("llm"):
+        response = ollama_session.post(
+            url=settings.OLLAMA_ENDPOINT, json=payload, timeout=settings.OLLAMA_TIMEOUT
+        )
+        response.raise_for_status()
+        response_data = response.json()
+
+    if "response" not in response_data:
+        raise requests.RequestException(
+            f"unexpected Ollama response: {response_data}", response=response
+        )
+
+    return response_data
+
+
+@app.route("/question", methods=["POST"])
+def question() -> dict:
+    query = request.json.get("query")
+    conversation_context = request.json.get("context")
+
+    if not query:
+        return {}
 
-    return {"response": response_text}
+    try:
+        search_filter = SearchFilter.from_dict(request.json.get("filters"))
+    except ValueError as exc:
+        return {"error": str(exc)}, 400
+
+    try:
+        llm_admission.check()
+    except admission.Rejected as exc:
+        return _rejected(exc)
+
+    # Under load the cross-encoder is skipped, the embedding ranking is kept
+    rerank = not (settings.ADMISSION_SKIP_RERANK_WHEN_BUSY and llm_admission.busy)
+    degraded = None if rerank else "no_rerank"
+
+    with metrics.request_timings() as timings:
+        context = embedding.retrieve(
+            query,
+            top_k=settings.RERANK_TOP_K,
+            rerank=rerank,
+            search_filter=search_filter,
+        )
+        # context = faiss_index.search(query, top_k=20, rerank=True)
+        # context = graph.retrieve(query)
+
+        fixed_parts = (
+            settings.OLLAMA_SYSTEM_PROMPT,
+            settings.OLLAMA_INSTRUCTION_PREFIX,
+            f"Pergunta: {query}",
+        )
+        # The context returned by Ollama holds the whole previous exchange and
+        # takes up num_ctx as well, so it is counted in the packing budget
+        conversation_context = context_assembler.fit_conversation(
+            conversation_context, *fixed_parts
+        )
+        blocks = context_assembler.assemble(
+            context,
+            *fixed_parts,
+            context_tokens=len(conversation_context or []),
+        )
+
+        payload = build_payload(query, blocks, conversation_context)
+        logger.debug("[Payload enviado]: %s", payload, extra={"sampled": True})
+
+        try:
+            response_data = generate(payload)
+        except (admission.Rejected, requests.RequestException) as exc:
+            if not settings.ADMISSION_RETRIEVAL_ONLY_FALLBACK:
+                if isinstance(exc, admission.Rejected):
+                    return _rejected(exc)
+
+                if isinstance(exc, requests.Timeout):
+                    return {"error": "timed out waiting for the model"}, 504
+
+                logger.error(f"model call failed: {str(exc)}")
+                return {"error": "the model is unavailable"}, 502
+
+            logger.warning(f"answering with the sources only: {str(exc)}")
+            response_data = None
+            degraded = "retrieval_only"
+
+        if response_data is not None:
+            response_text = response_data["response"]
+            logger.debug("[Resposta]: %s", response_text, extra={"sampled": True})
+
+    logger.info("[Timings]: %s", timings)
+
+    if response_data is None:
+        return {
+            "response": None,
+            "sources": [
+                {"name": block["name"], "content": block["content"]} for block in blocks
+            ],
+            "degraded": degraded,
+            "timings": timings,
+        }
+
+    result = {"response": response_text, "timings": timings}
+
+    if degraded:
+        result["degraded"] = degraded
+
+    if settings.OLLAMA_RETURN_CONTEXT:
+        result["context"] = response_data.get("context")
+
+    return result
+
+
+@app.route("/ingest", methods=["POST"])
+def ingest() -> tuple[dict, int]:
+    path = (request.get_json(silent=True) or {}).get("path")
+
+    if not path:
+        return {"error": "missing path"}, 400
+
+    try:
+        job = ingestion.submit(
+            session,
+            os.path.join(settings.INGEST_DIR, path),
+            allowed_dir=settings.INGEST_DIR,
+        )
+    except ValueError as exc:
+        return {"error": str(exc)}, 400
+
+    return ingestion.job_record(job), 202
+
+
+@app.route("/ingest/<int:job_id>", methods=["GET"])
+def ingest_status(job_id: int) -> tuple[dict, int]:
+    job = crud.get_ingestion_job_by_id(session, job_id)
+
+    if job is None:
+        return {"error": "job not found"}, 404
+
+    return ingestion.job_record(job), 200
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint() -> Response:
+    return Response(
+        metrics.registry.render() + llm_admission.render("rag_llm"),
+        mimetype="text/plain; version=0.0.4",
+    )
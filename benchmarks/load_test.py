@@ -0,0 +1,221 @@
+"""
+Load test of /question against a local fake Ollama, reporting throughput,
+latency percentiles and rejections per concurrency level. The fake answers
+after a fixed delay and, like Ollama, only generates `--ollama-parallel`
+answers at once, so the server's admission control is what is measured.
+
+Start the fake Ollama, then the server pointed at it, then the load:
+
+    python -m benchmarks.load_test serve --port 11435
+    OLLAMA_ENDPOINT=http://127.0.0.1:11435/api/generate gunicorn app:app
+    python -m benchmarks.load_test run --concurrency 1 4 16 64 --duration 30
+
+`run` also starts the fake by itself when `--ollama-port` is given, which is
+enough when the server runs on the same host.
+"""
+
+import argparse
+import json
+import threading
+import time
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+
+
+QUERIES = [
+    "como calcula a média?",
+    "qual o prazo para trancamento de matrícula?",
+    "quantas faltas reprovam uma disciplina?",
+    "como solicitar aproveitamento de disciplinas?",
+    "quais os requisitos para colar grau?",
+]
+
+
+class FakeOllama(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: tuple, latency: float, parallel: int):
+        super().__init__(address, FakeOllamaHandler)
+        self.latency = latency
+        self.slots = threading.Semaphore(parallel)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.served = 0
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    def do_POST(self) -> None:
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        server = self.server
+
+        with server.lock:
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+
+        try:
+            with server.slots:
+                time.sleep(server.latency)
+        finally:
+            with server.lock:
+                server.active -= 1
+                server.served += 1
+
+        body = json.dumps(
+            {
+                "model": payload.get("model"),
+                "response": f"Resposta simulada ({len(payload.get('prompt', ''))} chars)",
+                "context": [1, 2, 3],
+                "done": True,
+            }
+        ).encode("utf-8")
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+def start_fake_ollama(port: int, latency: float, parallel: int) -> FakeOllama:
+    server = FakeOllama(("127.0.0.1", port), latency, parallel)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def _client(url: str, deadline: float, timeout: float, offset: int) -> list:
+    session = requests.Session()
+    samples = []
+    index = offset
+
+    while time.perf_counter() < deadline:
+        query = QUERIES[index % len(QUERIES)]
+        index += 1
+        start_time = time.perf_counter()
+
+        try:
+            response = session.post(url, json={"query": query}, timeout=timeout)
+            status = response.status_code
+            degraded = response.json().get("degraded") if status == 200 else None
+        except requests.RequestException:
+            status, degraded = "error", None
+
+        samples.append((status, degraded, time.perf_counter() - start_time))
+
+        if status in (429, 503):
+            # Honors the rejection the way a client backing off would
+            time.sleep(float(response.headers.get("Retry-After", 1)))
+
+    return samples
+
+
+def run_level(url: str, concurrency: int, duration: float, timeout: float) -> dict:
+    deadline = time.perf_counter() + duration
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(_client, url, deadline, timeout, client)
+            for client in range(concurrency)
+        ]
+        samples = [sample for future in futures for sample in future.result()]
+
+    statuses = Counter(status for status, _, _ in samples)
+    degraded = Counter(degraded for _, degraded, _ in samples if degraded)
+    latencies = np.array([elapsed for status, _, elapsed in samples if status == 200])
+    percentiles = (
+        np.percentile(latencies, [50, 95, 99]) * 1000 if len(latencies) else np.zeros(3)
+    )
+
+    return {
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "ok_per_s": statuses[200] / duration,
+        "p50_ms": float(percentiles[0]),
+        "p95_ms": float(percentiles[1]),
+        "p99_ms": float(percentiles[2]),
+        "statuses": {str(status): count for status, count in statuses.items()},
+        "degraded": dict(degraded),
+    }
+
+
+def _print_report(reports: list[dict]) -> None:
+    print(
+        f"{'concurrency':>11}{'requests':>10}{'ok/s':>8}{'p50 ms':>10}"
+        f"{'p95 ms':>10}{'p99 ms':>10}  statuses / degraded"
+    )
+
+    for report in reports:
+        print(
+            f"{report['concurrency']:>11}{report['requests']:>10}"
+            f"{report['ok_per_s']:>8.2f}{report['p50_ms']:>10.1f}"
+            f"{report['p95_ms']:>10.1f}{report['p99_ms']:>10.1f}  "
+            f"{report['statuses']} / {report['degraded']}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load tests the /question API.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="runs the fake Ollama")
+    serve_parser.add_argument("--port", type=int, default=11435)
+
+    run_parser = subparsers.add_parser("run", help="runs the load")
+    run_parser.add_argument("--url", default="http://127.0.0.1:5000/question")
+    run_parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    run_parser.add_argument("--duration", type=float, default=20.0)
+    run_parser.add_argument("--timeout", type=float, default=120.0)
+    run_parser.add_argument(
+        "--ollama-port", type=int, help="Also starts the fake Ollama on this port"
+    )
+    run_parser.add_argument("--output", help="Writes the reports as JSON to this path")
+
+    for subparser in (serve_parser, run_parser):
+        subparser.add_argument(
+            "--latency", type=float, default=1.0, help="Seconds per fake answer"
+        )
+        subparser.add_argument(
+            "--ollama-parallel", type=int, default=2, help="Answers generated at once"
+        )
+
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        fake_ollama = FakeOllama(
+            ("127.0.0.1", args.port), args.latency, args.ollama_parallel
+        )
+        print(f"fake Ollama listening on 127.0.0.1:{args.port}")
+        fake_ollama.serve_forever()
+        raise SystemExit
+
+    fake_ollama = None
+
+    if args.ollama_port:
+        fake_ollama = start_fake_ollama(
+            args.ollama_port, args.latency, args.ollama_parallel
+        )
+
+    reports = [
+        run_level(args.url, concurrency, args.duration, args.timeout)
+        for concurrency in args.concurrency
+    ]
+    _print_report(reports)
+
+    if fake_ollama is not None:
+        print(
+            f"fake Ollama: [{fake_ollama.served}] answers, "
+            f"[{fake_ollama.max_active}] concurrent calls at most"
+        )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(reports, output, indent=2)
@@ -0,0 +1,330 @@
+"""
+Retrieval benchmarks over a synthetic corpus. The embedding model and the
+cross-encoder are replaced by deterministic stubs, so it runs offline and only
+measures the retrieval code paths.
+
+    python -m benchmarks.retrieval --sizes 1000 10000 100000 --concurrency 1 4 8
+
+Each corpus size runs in a fresh process, so the reported peak RSS belongs to
+that size alone. Recall@k is measured against an exact cosine search.
+"""
+
+import argparse
+import json
+import logging
+import os
+import resource
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import get_context
+from operator import itemgetter
+
+import numpy as np
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+import settings
+
+
+WORDS_PER_CHUNK = 60
+CHUNKS_PER_DOCUMENT = 100
+VOCABULARY_SIZE = 20000
+QUERY_WORDS = 4
+INSERT_BATCH_SIZE = 1000
+
+
+class StubEmbedder:
+    """
+    Bag-of-words stand-in for the SentenceTransformer: each synthetic token
+    `t<id>` maps to a fixed random vector and a text is the sum of its tokens.
+    """
+
+    def __init__(self, word_vectors: np.ndarray):
+        self.word_vectors = word_vectors
+
+    def _encode_one(self, text: str) -> np.ndarray:
+        word_ids = [int(token[1:]) for token in text.split() if token[1:].isdigit()]
+
+        return self.word_vectors[word_ids].sum(axis=0)
+
+    def encode(self, texts, **kwargs) -> np.ndarray:
+        if isinstance(texts, str):
+            return self._encode_one(texts)
+
+        return np.stack([self._encode_one(text) for text in texts])
+
+
+class StubCrossEncoder:
+    def predict(self, pairs: list, **kwargs) -> np.ndarray:
+        return np.array(
+            [
+                len(set(query.split()) & set(content.split()))
+                for query, content in pairs
+            ],
+            dtype=np.float32,
+        )
+
+
+def _word_vectors(seed: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+
+    return rng.standard_normal(
+        (VOCABULARY_SIZE, settings.FAISS_DIMENSION), dtype=np.float32
+    )
+
+
+def build_database(path: str, size: int, queries: int, seed: int) -> list[str]:
+    """
+    Fills a new SQLite database with `size` synthetic chunks and returns the
+    benchmark queries, each made of a few words taken from a random chunk.
+    """
+    from models import database, schema
+
+    rng = np.random.default_rng(seed)
+    word_vectors = _word_vectors(seed)
+    word_probabilities = 1 / np.arange(1, VOCABULARY_SIZE + 1) ** 1.1
+    word_probabilities /= word_probabilities.sum()
+    query_rows = set(rng.choice(size, size=queries, replace=size < queries).tolist())
+    query_texts = []
+
+    engine = create_engine(f"sqlite:///{path}")
+    database.Base.metadata.create_all(bind=engine)
+    document_count = max(1, -(-size // CHUNKS_PER_DOCUMENT))
+
+    with engine.begin() as connection:
+        connection.execute(
+            schema.Document.__table__.insert(),
+            [
+                {
+                    "id": document_id,
+                    "filename": f"document-{document_id}",
+                    "name": f"document-{document_id}",
+                    "hash": f"document-{document_id}",
+                    "content": "",
+                    "is_active": True,
+                }
+                for document_id in range(1, document_count + 1)
+            ],
+        )
+
+        for start in range(0, size, INSERT_BATCH_SIZE):
+            batch_size = min(INSERT_BATCH_SIZE, size - start)
+            word_ids = rng.choice(
+                VOCABULARY_SIZE,
+                size=(batch_size, WORDS_PER_CHUNK),
+                p=word_probabilities,
+            )
+            batch_embeddings = word_vectors[word_ids].sum(axis=1)
+            rows = []
+
+            for offset in range(batch_size):
+                row = start + offset
+                words = [f"t{word_id}" for word_id in word_ids[offset]]
+
+                if row in query_rows:
+                    query_texts.append(
+                        " ".join(rng.choice(words, size=QUERY_WORDS, replace=False))
+                    )
+
+                rows.append(
+                    {
+                        "id": row + 1,
+                        "document_id": row // CHUNKS_PER_DOCUMENT + 1,
+                        "content": " ".join(words),
+                        "hash": str(row),
+                        "is_active": True,
+                        "embedding": batch_embeddings[offset].tobytes(),
+                    }
+                )
+
+            connection.execute(schema.Text.__table__.insert(), rows)
+
+    engine.dispose()
+    rng.shuffle(query_texts)
+
+    return query_texts
+
+
+def _latencies(search, queries: list[str]) -> tuple[np.ndarray, list]:
+    latencies = []
+    results = []
+
+    for query in queries:
+        start_time = time.perf_counter()
+        results.append(search(query))
+        latencies.append(time.perf_counter() - start_time)
+
+    return np.array(latencies), results
+
+
+def _throughput(search, queries: list[str], concurrency: int) -> float:
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start_time = time.perf_counter()
+        list(executor.map(search, queries))
+        elapsed = time.perf_counter() - start_time
+
+    return len(queries) / elapsed
+
+
+def _recall(results: list, exact_ids: list[set], top_k: int) -> float:
+    hits = [
+        len({row["id"] for row in result[:top_k]} & expected) / len(expected)
+        for result, expected in zip(results, exact_ids)
+        if expected
+    ]
+
+    return float(np.mean(hits)) if hits else 0.0
+
+
+def run_size(size: int, options: dict) -> dict:
+    from services import embeddings
+    from services.retrieval import FAISSIndex, Graph
+    from utils import helpers
+
+    settings.ENABLE_PERF_LOGGING = options["perf_logging"]
+    logging.getLogger("app").setLevel(logging.WARNING)
+    # The synthetic vocabulary is whitespace separated, so the punkt data
+    # isn't needed to expand the hybrid queries
+    embeddings.word_tokenize = lambda text, language=None: text.split()
+
+    top_k = options["top_k"]
+    report = {"size": size, "retrievers": {}}
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.db")
+        start_time = time.perf_counter()
+        queries = build_database(path, size, options["queries"], options["seed"])
+        report["populate_s"] = time.perf_counter() - start_time
+
+        engine = create_engine(f"sqlite:///{path}")
+        session = scoped_session(sessionmaker(bind=engine))
+        embedder = embeddings.Embeddings(
+            session,
+            model=StubEmbedder(_word_vectors(options["seed"])),
+            cross_encoder=StubCrossEncoder(),
+        )
+        wordnet_syn = embeddings.WordnetSyn(preload=False)
+
+        start_time = time.perf_counter()
+        embedder.load_corpus()
+        report["corpus_load_s"] = time.perf_counter() - start_time
+
+        corpus = embedder.corpus
+        exact_ids = [
+            set(
+                corpus.ids[
+                    helpers.top_k_indices(
+                        corpus.scores(embedder.model.encode(query)), top_k
+                    )
+                ].tolist()
+            )
+            for query in queries
+        ]
+
+        retrievers = {
+            "embeddings.retrieve": lambda query: embedder.retrieve(
+                query, top_k=top_k, rerank=options["rerank"]
+            ),
+            "embeddings.retrieve_hybrid": lambda query: embedder.retrieve_hybrid(
+                query, wordnet_syn, top_k=top_k, rerank=options["rerank"]
+            ),
+        }
+
+        if size <= options["db_scan_max"]:
+            # The path taken by retrieve() when no corpus snapshot is loaded
+            retrievers["embeddings.retrieve[db scan]"] = lambda query: sorted(
+                embedder._fetch_results(query),
+                key=itemgetter("cosine_similarity"),
+                reverse=True,
+            )[:top_k]
+
+        faiss_index = FAISSIndex(session, embedder=embedder)
+        start_time = time.perf_counter()
+        faiss_index.build_index()
+        report["faiss_build_s"] = time.perf_counter() - start_time
+        retrievers["FAISSIndex.search"] = lambda query: faiss_index.search(
+            query, top_k=top_k, rerank=options["rerank"]
+        )
+
+        if size <= options["graph_max"]:
+            graph = Graph(session, embedder=embedder)
+            start_time = time.perf_counter()
+            graph.build_graph_network()
+            report["graph_build_s"] = time.perf_counter() - start_time
+            retrievers["Graph.retrieve"] = lambda query: graph.retrieve(
+                query, top_k=top_k
+            )
+
+        for name, search in retrievers.items():
+            search(queries[0])
+            latencies, results = _latencies(search, queries)
+            report["retrievers"][name] = {
+                "p50_ms": float(np.percentile(latencies, 50) * 1000),
+                "p95_ms": float(np.percentile(latencies, 95) * 1000),
+                "p99_ms": float(np.percentile(latencies, 99) * 1000),
+                f"recall@{top_k}": _recall(results, exact_ids, top_k),
+                "qps": {
+                    concurrency: _throughput(search, queries, concurrency)
+                    for concurrency in options["concurrency"]
+                },
+            }
+
+        session.remove()
+        engine.dispose()
+
+    report["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return report
+
+
+def _print_report(report: dict, top_k: int) -> None:
+    print(
+        f"\n[{report['size']} chunks] peak RSS: {report['peak_rss_mb']:.1f} MB, "
+        f"corpus load: {report['corpus_load_s']:.2f}s, "
+        f"FAISS build: {report['faiss_build_s']:.2f}s"
+    )
+    print(
+        f"{'retriever':<32}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+        f"{f'recall@{top_k}':>11}  qps (concurrency)"
+    )
+
+    for name, metrics in report["retrievers"].items():
+        qps = ", ".join(
+            f"{value:.1f} ({concurrency})"
+            for concurrency, value in metrics["qps"].items()
+        )
+        print(
+            f"{name:<32}{metrics['p50_ms']:>10.2f}{metrics['p95_ms']:>10.2f}"
+            f"{metrics['p99_ms']:>10.2f}{metrics[f'recall@{top_k}']:>11.3f}  {qps}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the retrievers.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--rerank", action="store_true")
+    parser.add_argument("--db-scan-max", type=int, default=50000)
+    parser.add_argument("--graph-max", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--perf-logging", action="store_true")
+    parser.add_argument("--output", help="Writes the reports as JSON to this path")
+    args = parser.parse_args()
+
+    reports = []
+
+    for size in args.sizes:
+        with ProcessPoolExecutor(1, mp_context=get_context("spawn")) as executor:
+            report = executor.submit(run_size, size, vars(args)).result()
+
+        _print_report(report, args.top_k)
+        reports.append(report)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            json.dump(reports, output, indent=2)
@@ -0,0 +1,37 @@
+# Usage: gunicorn app:app
+#
+# With preload_app the master imports app.py once: the models, the corpus
+# snapshot and the Wordnet mapping are built before forking, so the workers
+# share them copy-on-write instead of loading one copy each. The snapshot's
+# embedding matrix is a memory-mapped file, which stays shared through the page
+# cache when the workers later reload newer snapshots.
+import gc
+
+import settings
+
+bind = settings.SERVER_BIND
+workers = settings.SERVER_WORKERS
+threads = settings.SERVER_THREADS
+preload_app = True
+
+# Threads don't survive the fork: the ingestion worker is started by each
+# server worker instead of by the master
+settings.INGEST_WORKER_AUTOSTART = False
+
+
+def pre_fork(server, worker):
+    # Moves the objects built during preload out of the collector's reach, so
+    # the worker's garbage collections don't touch (and copy) the shared pages
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    from models import database
+    from utils import logging
+
+    database.init_worker()
+    logging.init_worker()
+
+    import app
+
+    app.ingestion_worker.start()
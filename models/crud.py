@@ -1,12 +1,48 @@
-from sqlalchemy import select
+import re
+
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy import text as sql
 from sqlalchemy.orm import Session
 
-from models.schema import Document, Text
+import settings
 
+from models.schema import Document, IngestionJob, Text
 from utils import helpers
 
 
-@helpers.measure_time
+def _fts_enabled() -> bool:
+    return settings.LEXICAL_BACKEND == "fts5"
+
+
+def _index_texts(session: Session, hashes: list[str]) -> None:
+    # texts_fts is an external-content table: it only stores the index, which
+    # has to be told about every row added to or removed from `texts`
+    if not _fts_enabled() or not hashes:
+        return
+
+    session.execute(
+        sql(
+            "INSERT INTO texts_fts (rowid, content) "
+            "SELECT id, content FROM texts WHERE hash IN :hashes"
+        ).bindparams(bindparam("hashes", expanding=True)),
+        {"hashes": hashes},
+    )
+
+
+def _unindex_texts(session: Session, text_ids: list[int]) -> None:
+    if not _fts_enabled() or not text_ids:
+        return
+
+    session.execute(
+        sql(
+            "INSERT INTO texts_fts (texts_fts, rowid, content) "
+            "SELECT 'delete', id, content FROM texts WHERE id IN :text_ids"
+        ).bindparams(bindparam("text_ids", expanding=True)),
+        {"text_ids": text_ids},
+    )
+
+
+@helpers.measure_time(stage="db")
 def create_document(
     session: Session,
     filepath: str,
@@ -14,6 +50,7 @@ def create_document(
     document_name: str,
     content: str,
     is_active: bool = True,
+    commit: bool = True,
 ) -> Document:
     document_hash = helpers.generate_hash_from_file(filepath)
     document = Document(
@@ -25,32 +62,46 @@ def create_document(
     )
 
     session.add(document)
-    session.commit()
+
+    if commit:
+        session.commit()
+    else:
+        session.flush()
 
     return document
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
 def get_document_by_id(session: Session, document_id: int) -> Document:
     return session.query(Document).filter_by(id=document_id).first()
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
 def get_document_by_hash(session: Session, hash: str) -> Document:
     return session.query(Document).filter_by(hash=hash).first()
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
 def get_all_documents(session: Session) -> list[Document]:
     return session.query(Document).all()
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
+def get_active_documents_by_filename(session: Session, filename: str) -> list[Document]:
+    return (
+        session.query(Document)
+        .filter_by(filename=filename, is_active=True)
+        .order_by(Document.id.desc())
+        .all()
+    )
+
+
+@helpers.measure_time(stage="db")
 def get_all_active_documents(session: Session) -> list[Document]:
     return session.query(Document).filter_by(is_active=True).all()
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
 def get_all_document_hashes(session: Session) -> set[str] | set:
     query = session.scalars(select(Document.hash)).all()
 
@@ -60,7 +111,7 @@ def get_all_document_hashes(session: Session) -> set[str] | set:
     return set()
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
 def update_document_active_status(
     session: Session, document_id: int, is_active: bool
 ) -> Document | None:
@@ -74,16 +125,35 @@ def update_document_active_status(
     return document
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
+def update_document_content(
+    session: Session, document_id: int, hash: str, content: str, commit: bool = True
+) -> Document | None:
+    document = session.query(Document).filter_by(id=document_id).first()
+
+    if not document:
+        return None
+
+    document.hash = hash
+    document.content = content
+
+    if commit:
+        session.commit()
+
+    return document
+
+
+@helpers.measure_time(stage="db")
 def delete_document(session: Session, document_id: int) -> None:
     document = session.query(Document).filter_by(id=document_id).first()
 
     if document:
+        _unindex_texts(session, [text.id for text in document.texts])
         session.delete(document)
         session.commit()
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
 def create_text(
     session: Session, document_id: int, content: str, embedding: bytes
 ) -> Text:
@@ -93,58 +163,192 @@ def create_text(
     )
 
     session.add(text)
+    session.flush()
+    _index_texts(session, [text_hash])
     session.commit()
 
     return text
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
+def bulk_create_texts(
+    session: Session, mappings: list[dict], commit: bool = True
+) -> None:
+    if not mappings:
+        return
+
+    session.bulk_insert_mappings(Text, mappings)
+    _index_texts(session, [mapping["hash"] for mapping in mappings])
+
+    if commit:
+        session.commit()
+
+
+@helpers.measure_time(stage="db")
 def get_text_by_id(session: Session, text_id: int) -> Text:
     return session.query(Text).filter_by(id=text_id).first()
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
 def get_texts_from_document_id(session: Session, document_id: int) -> list[Text]:
     return session.query(Text).filter_by(document_id=document_id).all()
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
 def get_all_texts(session: Session) -> list[Text]:
     return session.query(Text).all()
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
 def get_texts_from_active_documents(session: Session) -> list[Text]:
     return session.query(Text).join(Document).filter(Document.is_active == True).all()
 
 
-@helpers.measure_time
-def get_active_texts_from_active_documents(session: Session) -> list[Text]:
-    return (
+@helpers.measure_time(stage="db")
+def get_active_texts_from_active_documents(
+    session: Session, document_ids: list[int] | None = None
+) -> list[Text]:
+    query = (
         session.query(Text)
         .join(Document)
         .filter(Document.is_active == True)
         .filter(Text.is_active == True)
+    )
+
+    if document_ids is not None:
+        query = query.filter(Text.document_id.in_(document_ids))
+
+    return query.all()
+
+
+@helpers.measure_time(stage="db")
+def count_active_texts(session: Session) -> int:
+    return (
+        session.query(func.count(Text.id))
+        .join(Document)
+        .filter(Document.is_active == True)
+        .filter(Text.is_active == True)
+        .scalar()
+    )
+
+
+def iter_active_text_rows(
+    session: Session, content: bool = False, batch_size: int = 1000
+):
+    """
+    Streams the active texts' ids, embeddings and documents (and, optionally,
+    content) grouped by document, `batch_size` rows at a time. The document_id
+    index provides the grouping, so SQLite only sorts within each document.
+    """
+    columns = [
+        Text.id,
+        Text.document_id,
+        Text.embedding,
+        Document.filename,
+        Document.name,
+    ]
+
+    if content:
+        columns.append(Text.content)
+
+    return (
+        session.query(*columns)
+        .join(Document)
+        .filter(Document.is_active == True)
+        .filter(Text.is_active == True)
+        .order_by(Text.document_id, Text.position, Text.id)
+        .yield_per(batch_size)
+    )
+
+
+@helpers.measure_time(stage="db")
+def get_text_rows_in_id_list(session: Session, id_list: list[int]) -> list:
+    return (
+        session.query(
+            Text.id,
+            Text.document_id,
+            Text.content,
+            Text.position,
+            Text.start_offset,
+            Text.end_offset,
+            Document.filename,
+            Document.name,
+        )
+        .join(Document)
+        .filter(Text.id.in_(id_list))
         .all()
     )
 
 
-@helpers.measure_time
+def _fts_query(tokens: list[str]) -> str:
+    # Each token is quoted as a phrase, so no user input is read as an operator
+    phrases = {
+        '"{}"'.format(token.replace('"', '""'))
+        for token in tokens
+        if re.search(r"\w", token)
+    }
+
+    return " OR ".join(sorted(phrases))
+
+
+@helpers.measure_time(stage="db")
+def search_texts_fts(
+    session: Session,
+    tokens: list[str],
+    limit: int = settings.FTS_CANDIDATES,
+    document_ids: list[int] | None = None,
+) -> list[tuple[int, float]]:
+    """
+    Returns the (text id, score) pairs of the active texts matching any of the
+    tokens, best first, scored by FTS5's bm25() (negated, so higher is better).
+    """
+    query = _fts_query(tokens)
+
+    if not query or (document_ids is not None and not document_ids):
+        return []
+
+    statement = """
+        SELECT texts_fts.rowid, -bm25(texts_fts)
+        FROM texts_fts
+        JOIN texts ON texts.id = texts_fts.rowid
+        JOIN documents ON documents.id = texts.document_id
+        WHERE texts_fts MATCH :query AND texts.is_active AND documents.is_active
+    """
+    parameters = {"query": query, "limit": limit}
+
+    if document_ids is not None:
+        statement += " AND texts.document_id IN :document_ids"
+        parameters["document_ids"] = list(document_ids)
+
+    statement = sql(f"{statement} ORDER BY bm25(texts_fts) LIMIT :limit")
+
+    if document_ids is not None:
+        statement = statement.bindparams(bindparam("document_ids", expanding=True))
+
+    return [(row[0], row[1]) for row in session.execute(statement, parameters)]
+
+
+@helpers.measure_time(stage="db")
 def get_texts_by_hash(session: Session, hash: str) -> Text:
     return session.query(Text).filter_by(hash=hash).first()
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
 def get_all_text_hashes_in_list(session: Session, hash_list: list[str]) -> list[str]:
     return session.query(Text.hash).filter(Text.hash.in_(hash_list)).all()
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
+def get_texts_in_hash_list(session: Session, hash_list: list[str]) -> list[Text]:
+    return session.query(Text).filter(Text.hash.in_(hash_list)).all()
+
+
+@helpers.measure_time(stage="db")
 def get_texts_in_id_list(session: Session, id_list: list[int]) -> list[Text]:
     return session.query(Text).filter(Text.id.in_(id_list)).all()
 
 
-@helpers.measure_time
+@helpers.measure_time(stage="db")
 def update_text_active_status(
     session: Session, text_id: int, is_active: bool
 ) -> Text | None:
@@ -156,3 +360,155 @@ def update_text_active_status(
     text.is_active = is_active
 
     return text
+
+
+@helpers.measure_time(stage="db")
+def update_texts_active_status(
+    session: Session, text_ids: list[int], is_active: bool, commit: bool = True
+) -> int:
+    if not text_ids:
+        return 0
+
+    updated = (
+        session.query(Text)
+        .filter(Text.id.in_(text_ids))
+        .update({Text.is_active: is_active}, synchronize_session="fetch")
+    )
+
+    if commit:
+        session.commit()
+
+    return updated
+
+
+@helpers.measure_time(stage="db")
+def move_texts_to_document(
+    session: Session, text_ids: list[int], document_id: int, commit: bool = True
+) -> int:
+    if not text_ids:
+        return 0
+
+    updated = (
+        session.query(Text)
+        .filter(Text.id.in_(text_ids))
+        .update(
+            {Text.document_id: document_id, Text.is_active: True},
+            synchronize_session="fetch",
+        )
+    )
+
+    if commit:
+        session.commit()
+
+    return updated
+
+
+@helpers.measure_time(stage="db")
+def update_text_positions(
+    session: Session, positions: list[dict], commit: bool = True
+) -> None:
+    """
+    Bulk-updates the position and offsets of texts given as mappings holding
+    their id, `position`, `start_offset` and `end_offset`.
+    """
+    if not positions:
+        return
+
+    session.bulk_update_mappings(Text, positions)
+
+    if commit:
+        session.commit()
+
+
+@helpers.measure_time(stage="db")
+def create_ingestion_job(session: Session, filepath: str) -> IngestionJob:
+    job = IngestionJob(filepath=filepath)
+
+    session.add(job)
+    session.commit()
+
+    return job
+
+
+@helpers.measure_time(stage="db")
+def get_ingestion_job_by_id(session: Session, job_id: int) -> IngestionJob:
+    return session.query(IngestionJob).filter_by(id=job_id).first()
+
+
+@helpers.measure_time(stage="db")
+def get_pending_ingestion_filepaths(session: Session) -> set[str]:
+    return set(
+        session.scalars(
+            select(IngestionJob.filepath).where(
+                IngestionJob.status.in_(("pending", "running"))
+            )
+        ).all()
+    )
+
+
+@helpers.measure_time(stage="db")
+def claim_next_ingestion_job(session: Session) -> IngestionJob | None:
+    """
+    Marks the oldest pending job as running. The status check in the UPDATE
+    makes the claim atomic, so concurrent workers never pick the same job.
+    """
+    while True:
+        job_id = session.scalars(
+            select(IngestionJob.id)
+            .where(IngestionJob.status == "pending")
+            .order_by(IngestionJob.id)
+            .limit(1)
+        ).first()
+
+        if job_id is None:
+            session.commit()
+            return None
+
+        claimed = session.execute(
+            update(IngestionJob)
+            .where(IngestionJob.id == job_id, IngestionJob.status == "pending")
+            .values(status="running", updated_at=func.now())
+        ).rowcount
+        session.commit()
+
+        if claimed:
+            return session.get(IngestionJob, job_id)
+
+
+@helpers.measure_time(stage="db")
+def update_ingestion_job_status(
+    session: Session, job_id: int, status: str, error: str | None = None
+) -> IngestionJob | None:
+    job = session.query(IngestionJob).filter_by(id=job_id).first()
+
+    if not job:
+        return None
+
+    job.status = status
+    job.error = error
+    session.commit()
+
+    return job
+
+
+@helpers.measure_time(stage="db")
+def requeue_stale_ingestion_jobs(session: Session, older_than: float) -> int:
+    cutoff = func.datetime("now", f"-{int(older_than)} seconds")
+    updated = session.execute(
+        update(IngestionJob)
+        .where(IngestionJob.status == "running", IngestionJob.updated_at < cutoff)
+        .values(status="pending", updated_at=func.now())
+    ).rowcount
+    session.commit()
+
+    return updated
+
+
+@helpers.measure_time(stage="db")
+def count_finished_ingestion_jobs(session: Session) -> int:
+    count = session.scalar(
+        select(func.count(IngestionJob.id)).where(IngestionJob.status == "done")
+    )
+    session.commit()
+
+    return count
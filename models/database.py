@@ -1,4 +1,4 @@
-from sqlalchemy import create_engine, event
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.engine import Engine
 from sqlalchemy.orm import scoped_session, sessionmaker, declarative_base
 
@@ -21,8 +21,77 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     cursor.close()
 
 
-engine = create_engine(f"sqlite:///{settings.DB_FILENAME}")
+def _create_engine() -> Engine:
+    return create_engine(f"sqlite:///{settings.DB_FILENAME}")
+
+
+engine = _create_engine()
 session = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
 
 Base = declarative_base()
 Base.query = session.query_property()
+
+
+def init_worker() -> None:
+    """
+    Re-creates the engine after a fork, so that each worker opens its own SQLite
+    connections instead of inheriting the master's. The scoped session object is
+    kept and only rebound, as it is already referenced by the services.
+    """
+    global engine
+
+    session.remove()
+    engine.dispose(close=False)
+    engine = _create_engine()
+    session.configure(bind=engine)
+
+
+def migrate() -> None:
+    """
+    Adds the columns missing from tables created by an older version, which
+    create_all() leaves untouched. Only suitable for nullable columns, which is
+    how new columns are introduced.
+    """
+    inspector = inspect(engine)
+
+    with engine.begin() as connection:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+
+            existing_columns = {
+                column["name"] for column in inspector.get_columns(table.name)
+            }
+
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(
+                    text(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                    )
+                )
+
+
+def create_fts_index() -> None:
+    """
+    Creates the FTS5 index over the texts' content, rebuilding it when it is
+    out of sync with the table (e.g. after running with another backend).
+    """
+    with engine.begin() as connection:
+        connection.execute(
+            text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS texts_fts USING fts5("
+                "content, content='texts', content_rowid='id', "
+                f"tokenize='{settings.FTS_TOKENIZER}')"
+            )
+        )
+        indexed = connection.execute(text("SELECT count(*) FROM texts_fts_docsize"))
+        stored = connection.execute(text("SELECT count(*) FROM texts"))
+
+        if indexed.scalar() != stored.scalar():
+            connection.execute(
+                text("INSERT INTO texts_fts (texts_fts) VALUES ('rebuild')")
+            )
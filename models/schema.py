@@ -1,4 +1,6 @@
-from sqlalchemy import ForeignKey, LargeBinary
+from datetime import datetime
+
+from sqlalchemy import ForeignKey, LargeBinary, func
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 from models import database
@@ -33,8 +35,27 @@ class Text(database.Base):
     hash: Mapped[str] = mapped_column(nullable=False, unique=True)
     is_active: Mapped[bool] = mapped_column(default=True)
     embedding: Mapped[bytes] = mapped_column(LargeBinary, nullable=False)
+    position: Mapped[int | None] = mapped_column(nullable=True)
+    start_offset: Mapped[int | None] = mapped_column(nullable=True)
+    end_offset: Mapped[int | None] = mapped_column(nullable=True)
 
     document: Mapped["Document"] = relationship(back_populates="texts")
 
     def __repr__(self) -> str:
         return f"[{self.document_id}] - [{self.id}]"
+
+
+class IngestionJob(database.Base):
+    __tablename__ = "ingestion_jobs"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    filepath: Mapped[str] = mapped_column(nullable=False)
+    status: Mapped[str] = mapped_column(default="pending", index=True)
+    error: Mapped[str | None] = mapped_column(nullable=True)
+    created_at: Mapped[datetime] = mapped_column(server_default=func.now())
+    updated_at: Mapped[datetime] = mapped_column(
+        server_default=func.now(), onupdate=func.now()
+    )
+
+    def __repr__(self) -> str:
+        return f"[{self.id}] - {self.filepath} ({self.status})"
@@ -0,0 +1,117 @@
+import json
+import os
+import re
+
+from chonkie import RecursiveChunker, RecursiveRules
+
+import settings
+
+from utils import helpers
+from utils.logging import logger
+
+
+SECTION_BREAK = re.compile(r"[.!?:;]\s+")
+
+# The chunker of a chunking worker process, built once by its initializer
+_chunker = None
+
+
+def new_chunker() -> RecursiveChunker:
+    return RecursiveChunker(
+        tokenizer=settings.EMBEDDINGS_MODEL,
+        chunk_size=settings.CHUNK_SIZE,
+        rules=RecursiveRules(),
+        min_characters_per_chunk=settings.MIN_CHARS_PER_CHUNK,
+    )
+
+
+def init_worker() -> None:
+    global _chunker
+
+    _chunker = new_chunker()
+
+
+def chunk_section(
+    section: tuple[int, str], chunker: RecursiveChunker | None = None
+) -> list[tuple[int, int]]:
+    """
+    Chunk boundaries of an (offset, section) pair, as offsets in the whole
+    text. Without `chunker`, the worker process' own is used.
+    """
+    offset, text = section
+
+    return [
+        (offset + chunk.start_index, offset + chunk.end_index)
+        for chunk in (chunker or _chunker).chunk(text)
+    ]
+
+
+def split_sections(text: str, section_chars: int = settings.CHUNK_SECTION_CHARS):
+    """
+    Splits the text into sections of about `section_chars` characters, cut
+    after the last sentence end before the limit (or the last space, without
+    one), so they can be chunked independently. Returns (offset, section)
+    pairs, the offset being where the section starts in `text`.
+    """
+    sections = []
+    start = 0
+
+    while len(text) - start > section_chars:
+        limit = start + section_chars
+        breaks = [match.end() for match in SECTION_BREAK.finditer(text, start, limit)]
+        end = breaks[-1] if breaks else text.rfind(" ", start, limit) + 1
+
+        if end <= start:
+            end = limit
+
+        sections.append((start, text[start:end]))
+        start = end
+
+    if start < len(text):
+        sections.append((start, text[start:]))
+
+    return sections
+
+
+class ChunkCache:
+    """
+    Chunk boundaries, as (start, end) character offsets, stored per document
+    hash. The chunking settings are part of the key, so changing the model or
+    the chunk size invalidates the entries instead of reusing stale ones.
+    """
+
+    def __init__(self, directory: str = settings.CHUNK_CACHE_DIR):
+        self.directory = directory
+        self.config = helpers.generate_hash_from_string(
+            json.dumps(
+                [
+                    settings.EMBEDDINGS_MODEL,
+                    settings.CHUNK_SIZE,
+                    settings.MIN_CHARS_PER_CHUNK,
+                    settings.CHUNK_SECTION_CHARS,
+                ]
+            )
+        )[:16]
+
+    def _path(self, document_hash: str) -> str:
+        return os.path.join(self.directory, f"{document_hash}.{self.config}.json")
+
+    def get(self, document_hash: str) -> list[tuple[int, int]] | None:
+        try:
+            with open(self._path(document_hash), encoding="utf-8") as file:
+                return [tuple(span) for span in json.load(file)]
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as exc:
+            logger.warning(f"ignoring unreadable chunk cache entry: {str(exc)}")
+            return None
+
+    def put(self, document_hash: str, spans: list[tuple[int, int]]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(document_hash)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(spans, file)
+
+        os.replace(temporary_path, path)
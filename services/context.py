@@ -0,0 +1,198 @@
+from functools import lru_cache
+
+import numpy as np
+
+import settings
+
+from services.embeddings import Embeddings
+from utils import helpers
+from utils.logging import logger
+
+
+class ContextAssembler:
+    """
+    Packs the retrieved chunks into the generator's context window: chunks are
+    taken by value, near-duplicates are dropped, and what fits in the token
+    budget is merged per document so each source is only announced once.
+    """
+
+    def __init__(
+        self,
+        embedder: Embeddings,
+        tokenizer_name: str = settings.GENERATOR_TOKENIZER,
+        num_ctx: int = settings.OLLAMA_PARAMETERS["num_ctx"],
+        reserved_tokens: int = settings.CONTEXT_RESERVED_TOKENS,
+        dedup_threshold: float = settings.CONTEXT_DEDUP_THRESHOLD,
+        min_retrieval_tokens: int = settings.CONTEXT_MIN_RETRIEVAL_TOKENS,
+    ):
+        self.embedder = embedder
+        self.num_ctx = num_ctx
+        self.reserved_tokens = reserved_tokens
+        self.dedup_threshold = dedup_threshold
+        self.min_retrieval_tokens = min_retrieval_tokens
+        self.tokenizer = None
+
+        try:
+            from transformers import AutoTokenizer
+
+            self.tokenizer = AutoTokenizer.from_pretrained(tokenizer_name)
+        except Exception as exc:
+            logger.warning(
+                f"could not load the [{tokenizer_name}] tokenizer ({exc}), "
+                "estimating token counts from the text length instead"
+            )
+
+        self._count_tokens = lru_cache(maxsize=settings.CONTEXT_TOKEN_CACHE_SIZE)(
+            self.count_tokens
+        )
+
+    def count_tokens(self, text: str) -> int:
+        if self.tokenizer is None:
+            return int(len(text) / settings.CONTEXT_CHARS_PER_TOKEN) + 1
+
+        return len(self.tokenizer.encode(text, add_special_tokens=False))
+
+    @staticmethod
+    def _score(row: dict) -> float:
+        return row.get("rerank_score", row.get("cosine_similarity", 0.0))
+
+    @staticmethod
+    def render_block(block: dict) -> str:
+        return f"[CONTEXTO]: {block['content']}\nFonte: {block['name']}"
+
+    def budget(self, *fixed_parts: str, context_tokens: int = 0) -> int:
+        """
+        Tokens left for the chunks once `fixed_parts` and the `context_tokens`
+        of a previous exchange sent back to Ollama are accounted for.
+        """
+        fixed_tokens = sum(self._count_tokens(part) for part in fixed_parts)
+
+        return self.num_ctx - self.reserved_tokens - fixed_tokens - context_tokens
+
+    def fit_conversation(
+        self, conversation_context: list[int] | None, *fixed_parts: str
+    ) -> list[int] | None:
+        """
+        Returns the conversation context to send back, or None when keeping it
+        would leave less than `min_retrieval_tokens` for the chunks: Ollama
+        would otherwise silently truncate the prompt.
+        """
+        if not conversation_context:
+            return None
+
+        budget = self.budget(*fixed_parts, context_tokens=len(conversation_context))
+
+        if budget < self.min_retrieval_tokens:
+            logger.info(
+                f"dropping the conversation context ([{len(conversation_context)}] "
+                f"tokens), only [{budget}] tokens would be left for the chunks"
+            )
+            return None
+
+        return conversation_context
+
+    def _embeddings(self, rows: list[dict]) -> np.ndarray:
+        corpus = self.embedder.corpus
+
+        if corpus is not None:
+            corpus_rows = corpus.rows_of([row["id"] for row in rows])
+
+            if (corpus_rows >= 0).all():
+                return corpus.embeddings[corpus_rows]
+
+        return helpers.normalize_rows(
+            self.embedder.generate_embeddings([row["content"] for row in rows])
+        )
+
+    @helpers.measure_time
+    def deduplicate(self, rows: list[dict]) -> list[dict]:
+        if len(rows) < 2:
+            return rows
+
+        similarities = self._embeddings(rows)
+        similarities = similarities @ similarities.T
+        kept = []
+
+        for index, row in enumerate(rows):
+            if all(similarities[index, other] < self.dedup_threshold for other in kept):
+                kept.append(index)
+
+        logger.info(f"[{len(rows) - len(kept)}] near-duplicate chunks dropped")
+
+        return [rows[index] for index in kept]
+
+    @staticmethod
+    def _reading_order(row: dict) -> tuple:
+        position = row.get("position")
+
+        return position is None, position or 0, row["id"]
+
+    def _merge(self, rows: list[dict]) -> list[dict]:
+        """
+        Groups the rows per document in reading order. Adjacent chunks are
+        contiguous slices of the document, so they are joined back as is.
+        """
+        blocks = {}
+
+        for row in rows:
+            block = blocks.setdefault(
+                row["document_id"],
+                {"document_id": row["document_id"], "name": row["name"], "rows": []},
+            )
+            block["rows"].append(row)
+
+        for block in blocks.values():
+            block["rows"].sort(key=self._reading_order)
+            parts = []
+            previous = None
+
+            for row in block["rows"]:
+                if parts and not (
+                    row.get("start_offset") is not None
+                    and row["start_offset"] == previous.get("end_offset")
+                ):
+                    parts.append(" ")
+
+                parts.append(row["content"])
+                previous = row
+
+            block["content"] = "".join(parts)
+
+        return list(blocks.values())
+
+    @helpers.measure_time
+    def assemble(
+        self, rows: list[dict], *fixed_parts: str, context_tokens: int = 0
+    ) -> list[dict]:
+        """
+        Returns the context blocks that fit the budget left by `fixed_parts`
+        (system prompt, instructions, question) and the `context_tokens` of the
+        conversation context, best scoring ones first.
+        """
+        budget = self.budget(*fixed_parts, context_tokens=context_tokens)
+        rows = self.deduplicate(sorted(rows, key=self._score, reverse=True))
+        header_tokens = self._count_tokens(
+            self.render_block({"content": "", "name": ""})
+        )
+        selected = []
+        used_tokens = 0
+        seen_documents = set()
+
+        for row in rows:
+            cost = self._count_tokens(row["content"])
+
+            if row["document_id"] not in seen_documents:
+                cost += header_tokens + self._count_tokens(row["name"])
+
+            if used_tokens + cost > budget:
+                continue
+
+            selected.append(row)
+            seen_documents.add(row["document_id"])
+            used_tokens += cost
+
+        logger.info(
+            f"[{len(selected)}/{len(rows)}] chunks packed in [{used_tokens}/{budget}] tokens"
+        )
+
+        return self._merge(selected)
@@ -0,0 +1,374 @@
+import glob
+import hashlib
+import os
+import shutil
+
+import numpy as np
+
+from numpy.lib.format import open_memmap
+from rank_bm25 import BM25Okapi
+from sqlalchemy.orm import Session
+
+import settings
+
+from models import crud
+from services.filters import SearchFilter
+from utils import helpers
+from utils.logging import logger
+
+
+SNAPSHOTS_KEPT = 3
+SNAPSHOT_LOAD_ATTEMPTS = 3
+NORMALIZE_BLOCK_ROWS = 4096
+
+
+class SnapshotChanged(Exception):
+    """
+    Raised when the active texts changed while a snapshot was being written.
+    """
+
+
+def _modified_at(path: str) -> float:
+    try:
+        return os.path.getmtime(path)
+    except FileNotFoundError:
+        return 0.0
+
+
+def _remove_old_snapshots(directory: str, keep: int = SNAPSHOTS_KEPT) -> None:
+    # Processes mapping a removed snapshot keep their mappings, and the most
+    # recent ones are kept for the shard workers that haven't mapped theirs yet
+    paths = glob.glob(os.path.join(directory, "snapshot-*"))
+
+    for path in sorted(paths, key=_modified_at, reverse=True)[keep:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class _SnapshotWriter:
+    """
+    Streams the rows into `ids.npy` and `embeddings.npy` in `path`, normalizing
+    the embeddings a block at a time, and collects the document ranges. Only a
+    block of embeddings is held in memory at once.
+    """
+
+    def __init__(self, path: str, size: int):
+        self.path = path
+        self.size = size
+        self.ids = open_memmap(
+            os.path.join(path, "ids.npy"), mode="w+", dtype=np.int64, shape=(size,)
+        )
+        self.embeddings = None
+        self.documents = {}
+        self.document_ranges = {}
+        self._block = []
+        self._written = 0
+
+    def add(self, row):
+        row_index = self._written + len(self._block)
+
+        if row_index >= self.size:
+            raise SnapshotChanged("more active texts than counted")
+
+        self.ids[row_index] = row.id
+        self._block.append(np.frombuffer(row.embedding, dtype=np.float32))
+        document_id = row.document_id
+
+        if document_id not in self.documents:
+            self.documents[document_id] = {
+                "id": document_id,
+                "filename": row.filename,
+                "name": row.name,
+            }
+            self.document_ranges[document_id] = (row_index, row_index + 1)
+        else:
+            start, end = self.document_ranges[document_id]
+
+            if end != row_index:
+                raise ValueError("the corpus rows must be grouped by document")
+
+            self.document_ranges[document_id] = (start, row_index + 1)
+
+        if len(self._block) == NORMALIZE_BLOCK_ROWS:
+            self._flush()
+
+        return row
+
+    def _flush(self) -> None:
+        if not self._block:
+            return
+
+        block = helpers.normalize_rows(np.stack(self._block))
+
+        if self.embeddings is None:
+            self.embeddings = open_memmap(
+                os.path.join(self.path, "embeddings.npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(self.size, block.shape[1]),
+            )
+
+        self.embeddings[self._written : self._written + len(block)] = block
+        self._written += len(block)
+        self._block = []
+
+    def close(self) -> str:
+        """
+        Completes the files and returns the hash of their contents.
+        """
+        self._flush()
+
+        if self._written != self.size:
+            raise SnapshotChanged("fewer active texts than counted")
+
+        # Sorted view of the ids, for looking rows up by text id
+        np.save(os.path.join(self.path, "id_order.npy"), np.argsort(self.ids))
+        digest = hashlib.sha256(self.ids)
+        digest.update(self.embeddings)
+        self.ids.flush()
+        self.embeddings.flush()
+        self.ids = self.embeddings = None
+
+        return digest.hexdigest()[:16]
+
+
+class Corpus:
+    """
+    Read-only snapshot of the active texts: their ids and L2-normalized
+    embedding matrix, memory-mapped from a directory named after a hash of its
+    contents, and the documents' row ranges. Every process loading the same
+    snapshot (server and shard workers alike) maps the same files, so the
+    matrix is shared through the page cache instead of copied per process, and
+    it can outgrow a process's memory. The texts' content is read from the
+    database for the returned results only. With the rank_bm25 backend each
+    process still builds its own BM25 postings, the fts5 one keeps them in
+    SQLite.
+
+    The rows are grouped by document, so that each document maps to a
+    contiguous range of rows and a filtered search only scans its slices.
+    """
+
+    def __init__(
+        self,
+        session: Session,
+        path: str | None,
+        documents: dict,
+        document_ranges: dict,
+        bm25: BM25Okapi | None = None,
+    ):
+        self.session = session
+        self.path = path
+        self.documents = documents
+        self.document_ranges = document_ranges
+        self.bm25 = bm25
+        self.searcher = None
+
+        if path is None:
+            self.ids = np.empty(0, dtype=np.int64)
+            self.id_order = np.empty(0, dtype=np.int64)
+            self.embeddings = np.empty((0, 0), dtype=np.float32)
+        else:
+            self.ids = np.load(os.path.join(path, "ids.npy"), mmap_mode="r")
+            self.id_order = np.load(os.path.join(path, "id_order.npy"), mmap_mode="r")
+            self.embeddings = np.load(self.embeddings_path, mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def embeddings_path(self) -> str | None:
+        if self.path is None:
+            return None
+
+        return os.path.join(self.path, "embeddings.npy")
+
+    @classmethod
+    @helpers.measure_time
+    def from_session(
+        cls,
+        session: Session,
+        build_bm25: bool = True,
+        directory: str = settings.SNAPSHOT_DIR,
+    ) -> "Corpus":
+        """
+        Streams the active texts into a new snapshot, or maps the published
+        one when another process already wrote the same contents.
+        """
+        logger.info("loading the corpus snapshot...")
+
+        for attempt in range(1, SNAPSHOT_LOAD_ATTEMPTS + 1):
+            try:
+                corpus = cls._write(session, build_bm25, directory)
+                break
+            except SnapshotChanged as exc:
+                if attempt == SNAPSHOT_LOAD_ATTEMPTS:
+                    raise
+
+                logger.warning(f"reloading the corpus snapshot: {str(exc)}")
+
+        logger.info(f"corpus snapshot loaded: [{len(corpus)}] texts at [{corpus.path}]")
+
+        return corpus
+
+    @classmethod
+    def _write(cls, session: Session, build_bm25: bool, directory: str) -> "Corpus":
+        size = crud.count_active_texts(session)
+
+        if not size:
+            return cls(session, None, {}, {})
+
+        os.makedirs(directory, exist_ok=True)
+        temporary_path = os.path.join(directory, f"snapshot.{os.getpid()}.tmp")
+        shutil.rmtree(temporary_path, ignore_errors=True)
+        os.makedirs(temporary_path)
+
+        try:
+            writer = _SnapshotWriter(temporary_path, size)
+            rows = crud.iter_active_text_rows(session, content=build_bm25)
+            bm25 = None
+
+            if build_bm25:
+                # BM25Okapi consumes the stream itself, so the contents are
+                # tokenized one at a time instead of being all held at once
+                bm25 = BM25Okapi(writer.add(row).content.split() for row in rows)
+            else:
+                for row in rows:
+                    writer.add(row)
+
+            path = os.path.join(directory, f"snapshot-{writer.close()}")
+        except BaseException:
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            raise
+
+        try:
+            os.rename(temporary_path, path)
+        except OSError:
+            # Already published, by this or another process
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            os.utime(path)
+
+        _remove_old_snapshots(directory)
+
+        return cls(session, path, writer.documents, writer.document_ranges, bm25)
+
+    def rows_of(self, text_ids) -> np.ndarray:
+        """
+        The rows of the given text ids, -1 for those not in the snapshot.
+        """
+        text_ids = np.asarray(text_ids, dtype=np.int64)
+
+        if not len(self):
+            return np.full(len(text_ids), -1, dtype=np.int64)
+
+        positions = np.searchsorted(self.ids, text_ids, sorter=self.id_order)
+        rows = self.id_order[np.minimum(positions, len(self) - 1)]
+
+        return np.where(self.ids[rows] == text_ids, rows, -1)
+
+    def pack(self, rows, similarities) -> list:
+        """
+        The result records of the given rows, with their content read from the
+        database. Texts deleted since the snapshot was taken are left out.
+        """
+        text_ids = [int(self.ids[row]) for row in rows]
+        texts = {
+            text.id: text
+            for text in crud.get_text_rows_in_id_list(self.session, text_ids)
+        }
+        results = []
+
+        for text_id, similarity in zip(text_ids, similarities):
+            text = texts.get(text_id)
+
+            if text is None:
+                continue
+
+            results.append(
+                {
+                    "id": text.id,
+                    "document_id": text.document_id,
+                    "filename": text.filename,
+                    "name": text.name,
+                    "content": text.content,
+                    "position": text.position,
+                    "start_offset": text.start_offset,
+                    "end_offset": text.end_offset,
+                    "cosine_similarity": float(similarity),
+                }
+            )
+
+        return results
+
+    def ranges(self, search_filter: SearchFilter | None) -> list | None:
+        """
+        Row ranges of the documents matching the filter, with neighbouring
+        ranges coalesced, or None when every row is searched.
+        """
+        if search_filter is None:
+            return None
+
+        ranges = []
+
+        for document_id, document in self.documents.items():
+            if not search_filter.matches(document):
+                continue
+
+            start, end = self.document_ranges[document_id]
+
+            if ranges and ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], end)
+            else:
+                ranges.append((start, end))
+
+        return ranges
+
+    @staticmethod
+    def rows_in(ranges: list) -> np.ndarray:
+        if not ranges:
+            return np.empty(0, dtype=np.int64)
+
+        return np.concatenate([np.arange(start, end) for start, end in ranges])
+
+    @helpers.measure_time(stage="scan")
+    def scores(
+        self, query_embedding: np.ndarray, ranges: list | None = None
+    ) -> np.ndarray:
+        """
+        Cosine similarities of every searched row, in row order, computed by
+        the shard workers when the corpus is sharded.
+        """
+        if self.searcher is not None:
+            return self.searcher.scores(query_embedding, ranges)
+
+        query_embedding = helpers.normalize_rows(query_embedding)
+
+        if ranges is None:
+            return self.embeddings @ query_embedding
+
+        if not ranges:
+            return np.empty(0, dtype=np.float32)
+
+        return np.concatenate(
+            [self.embeddings[start:end] @ query_embedding for start, end in ranges]
+        )
+
+    def search(
+        self,
+        query_embedding: np.ndarray,
+        top_k: int = 5,
+        search_filter: SearchFilter | None = None,
+    ) -> list:
+        if not len(self):
+            return []
+
+        ranges = self.ranges(search_filter)
+
+        if self.searcher is not None:
+            rows, scores = self.searcher.search(query_embedding, top_k, ranges)
+
+            return self.pack(rows, scores)
+
+        scores = self.scores(query_embedding, ranges)
+        best = helpers.top_k_indices(scores, top_k)
+        rows = best if ranges is None else self.rows_in(ranges)[best]
+
+        return self.pack(rows, scores[best])
@@ -1,12 +1,19 @@
+import heapq
+import os
+import queue
 import re
+import threading
+import time
 
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import get_context
+from operator import itemgetter
 from typing import Optional
 
 import numpy as np
 
-from chonkie import RecursiveChunker, RecursiveRules
-from sentence_transformers import SentenceTransformer, CrossEncoder
 from sklearn.metrics.pairwise import cosine_similarity
 from sqlalchemy.orm import Session
 from nltk.tokenize import word_tokenize
@@ -15,9 +22,13 @@ from rank_bm25 import BM25Okapi
 
 import settings
 
-from utils import helpers
+from utils import helpers, metrics
 from utils.logging import logger
 from models import crud, schema
+from services import chunking, inference
+from services.corpus import Corpus
+from services.filters import SearchFilter, document_record
+from services.sharding import ShardedSearcher
 
 
 class WordnetSyn:
@@ -46,94 +57,365 @@ class WordnetSyn:
             lemma: frozenset(synonyms) for lemma, synonyms in self.syn_mapping.items()
         }
 
-    @helpers.measure_time
     def get_synonyms(self, token: str) -> frozenset:
         return self.syn_mapping.get(token, frozenset())
 
 
 class Embeddings:
-    def __init__(self, session: Session):
+    def __init__(self, session: Session, model=None, cross_encoder=None):
         self.session = session
-        self.model = SentenceTransformer(settings.EMBEDDINGS_MODEL)
-        self.cross_encoder = CrossEncoder(settings.CROSSENCODER_MODEL)
-        self.chunker = RecursiveChunker(
-            tokenizer=settings.EMBEDDINGS_MODEL,
-            chunk_size=settings.CHUNK_SIZE,
-            rules=RecursiveRules(),
-            min_characters_per_chunk=settings.MIN_CHARS_PER_CHUNK,
-        )
+        self.model = model or inference.load_embedder()
+        self.cross_encoder = cross_encoder or inference.load_cross_encoder()
+        self._chunkers = queue.SimpleQueue()
+        self._chunk_pool = None
+        self._chunk_pool_pid = None
+        self._chunk_pool_lock = threading.Lock()
+        self.chunk_cache = chunking.ChunkCache()
         self.wordnet_syn = None
+        self.corpus = None
+        self._previous_corpus = None
         logger.info(
             f"initializing the embeddings class [model: {settings.EMBEDDINGS_MODEL}]"
         )
 
+    @contextmanager
+    def _borrow_chunker(self):
+        """
+        Lends a chunker for the calling thread's exclusive use. Neither chonkie
+        nor the tokenizer it wraps is documented as thread-safe, so threads
+        never share one: each borrows its own, built on first need and kept
+        for the next borrowers.
+        """
+        try:
+            chunker = self._chunkers.get_nowait()
+        except queue.Empty:
+            chunker = chunking.new_chunker()
+
+        try:
+            yield chunker
+        finally:
+            self._chunkers.put(chunker)
+
+    def _chunking_processes(self) -> ProcessPoolExecutor:
+        """
+        Worker processes with a chunker each, started on first need: chonkie's
+        recursive splitting runs Python code under the GIL, so threads don't
+        chunk in parallel. Spawned rather than forked, as this process runs
+        other threads.
+        """
+        with self._chunk_pool_lock:
+            if self._chunk_pool is None or self._chunk_pool_pid != os.getpid():
+                self._chunk_pool = ProcessPoolExecutor(
+                    max_workers=settings.CHUNK_WORKERS,
+                    mp_context=get_context("spawn"),
+                    initializer=chunking.init_worker,
+                )
+                self._chunk_pool_pid = os.getpid()
+                logger.info(f"[{settings.CHUNK_WORKERS}] chunking workers started")
+
+            return self._chunk_pool
+
+    def close_chunking_processes(self) -> None:
+        with self._chunk_pool_lock:
+            if self._chunk_pool is not None and self._chunk_pool_pid == os.getpid():
+                self._chunk_pool.shutdown()
+
+            self._chunk_pool = None
+
+    def load_corpus(self) -> None:
+        corpus = Corpus.from_session(
+            self.session, build_bm25=settings.LEXICAL_BACKEND == "rank_bm25"
+        )
+
+        if settings.SEARCH_SHARDS > 1 and len(corpus):
+            corpus.searcher = ShardedSearcher.from_corpus(corpus)
+
+        self.swap_corpus(corpus)
+
+    def swap_corpus(self, corpus: Corpus) -> None:
+        """
+        Publishes a new snapshot with a single assignment: queries read
+        `self.corpus` once, so each one keeps the snapshot it started with. The
+        replaced snapshot is kept until the next swap, letting the searches
+        still running on it finish before its shard workers are stopped.
+        """
+        retired = self._previous_corpus
+        self._previous_corpus = self.corpus
+        self.corpus = corpus
+
+        if retired is not None and retired.searcher is not None:
+            retired.searcher.close()
+
     def tokenize(self, chunks: list) -> list:
         return [self.model.tokenize(chunk, return_tensors="pt") for chunk in chunks]
 
+    @helpers.measure_time(stage="encode")
+    def encode_query(self, query: str) -> np.ndarray:
+        return self.model.encode(query)
+
     def generate_embeddings(self, chunks: list):
         return self.model.encode(chunks, convert_to_numpy=True)
 
-    def _remove_meaningless_chunks(self, chunks: list[str]) -> list[str]:
+    def _remove_meaningless_chunks(self, chunks: list[dict]) -> list[dict]:
         filtered_chunks = [
-            string for string in chunks if re.search(r"[a-zA-Z0-9]", string)
+            chunk for chunk in chunks if re.search(r"[a-zA-Z0-9]", chunk["content"])
         ]
         logger.info(f"[{len(chunks) - len(filtered_chunks)}] chunks filtered out")
         return filtered_chunks
 
-    def generate_chunks(self, text: str) -> list:
-        chunks = list(set([chunk.text for chunk in self.chunker.chunk(text)]))
+    @helpers.measure_time
+    def chunk_spans(
+        self, text: str, document_hash: Optional[str] = None
+    ) -> list[tuple[int, int]]:
+        """
+        Returns the chunk boundaries of the text as character offsets, in
+        reading order. Documents chunked before are read from the cache, the
+        others are split in sections chunked in parallel by `CHUNK_WORKERS`
+        processes.
+        """
+        if document_hash:
+            spans = self.chunk_cache.get(document_hash)
+
+            if spans is not None:
+                logger.info(f"[{len(spans)}] chunk boundaries read from the cache")
+                return spans
+
+        sections = chunking.split_sections(text)
+
+        if len(sections) > 1 and settings.CHUNK_WORKERS > 1:
+            section_spans = list(
+                self._chunking_processes().map(chunking.chunk_section, sections)
+            )
+        else:
+            with self._borrow_chunker() as chunker:
+                section_spans = [
+                    chunking.chunk_section(section, chunker) for section in sections
+                ]
+
+        spans = [span for spans in section_spans for span in spans]
+
+        if document_hash:
+            self.chunk_cache.put(document_hash, spans)
+
+        return spans
+
+    def generate_chunks(self, text: str, document_hash: Optional[str] = None) -> list:
+        """
+        Returns the document's distinct chunks in reading order, each with its
+        position and character offsets in the text.
+        """
+        chunks = []
+        seen_contents = set()
+
+        for start, end in self.chunk_spans(text, document_hash):
+            content = text[start:end]
+
+            if content in seen_contents:
+                continue
+
+            seen_contents.add(content)
+            chunks.append(
+                {"content": content, "start_offset": start, "end_offset": end}
+            )
+
         chunks = self._remove_meaningless_chunks(chunks)
 
+        for position, chunk in enumerate(chunks):
+            chunk["position"] = position
+
         return chunks
 
-    def process_data(self, data: dict) -> None:
+    def process_data(self, data: dict) -> dict:
+        """
+        Syncs the document's texts with its current content: only chunks not
+        stored yet are embedded, the document's texts whose chunks are gone are
+        deactivated, and stored texts matching a chunk that are inactive or
+        left behind by an outdated document are reused with their embeddings.
+        Returns the counts, so callers know whether the indices need a rebuild.
+
+        Every change, including the document's new hash and content, is
+        committed at once: a failure leaves the previous version in place, so
+        the file is not taken as ingested and can be resubmitted.
+        """
+        try:
+            counts = self._sync_texts(data)
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            raise
+
+        logger.info(
+            f"[{data.get('filename')}] [{counts['inserted']}] embeddings saved, "
+            f"[{counts['deactivated']}] texts deactivated, "
+            f"[{counts['reactivated']}] reactivated!"
+        )
+
+        return counts
+
+    def _sync_texts(self, data: dict) -> dict:
         logger.info(f"processing data for {data.get('filename')}...")
-        chunks = self.generate_chunks(data.get("content"))
+        chunks = self.generate_chunks(data.get("content"), data.get("hash"))
         total_chunks = len(chunks)
         logger.info(f"[{data.get('filename')}] [{total_chunks}] chunks generated!")
 
-        chunk_hashes = [helpers.generate_hash_from_string(chunk) for chunk in chunks]
-        existing_hashes = crud.get_all_text_hashes_in_list(self.session, chunk_hashes)
-        existing_hash_set = {hash_tuple[0] for hash_tuple in existing_hashes}
+        for chunk in chunks:
+            chunk["hash"] = helpers.generate_hash_from_string(chunk["content"])
 
-        insert_data = []
+        chunks_by_hash = {chunk["hash"]: chunk for chunk in chunks}
+        existing_texts = crud.get_texts_in_hash_list(self.session, list(chunks_by_hash))
+        existing_hash_set = {text.hash for text in existing_texts}
+        new_chunks = [
+            chunk for chunk in chunks if chunk["hash"] not in existing_hash_set
+        ]
+        embeddings = []
 
-        for chunk, chunk_hash in zip(chunks, chunk_hashes):
-            if chunk_hash in existing_hash_set:
-                continue
+        # Embedded before the first write: SQLite only takes the write lock
+        # then, so other writers aren't blocked meanwhile
+        if new_chunks:
+            embeddings = self.generate_embeddings(
+                [chunk["content"] for chunk in new_chunks]
+            )
+
+        document_id = data.get("document_id")
 
-            embedding = self.generate_embeddings(chunk)
-            insert_data.append(
-                {
-                    "document_id": data["document_id"],
-                    "content": chunk,
-                    "hash": chunk_hash,
-                    "embedding": embedding.tobytes(),
-                }
+        if document_id is None:
+            document = crud.create_document(
+                self.session,
+                data["filepath"],
+                data["filename"],
+                document_name=data["name"],
+                content=data["content"],
+                commit=False,
+            )
+            document_id = document.id
+            logger.info(
+                f"created new database entry for [{data['filepath']}]: [{document_id}]"
             )
 
-        if insert_data:
-            self.session.bulk_insert_mappings(schema.Text, insert_data)
-            self.session.commit()
+        insert_data = [
+            {
+                **chunk,
+                "document_id": document_id,
+                "embedding": np.asarray(embedding, dtype=np.float32).tobytes(),
+            }
+            for chunk, embedding in zip(new_chunks, embeddings)
+        ]
+        document_texts = crud.get_texts_from_document_id(self.session, document_id)
+        removed_ids = [
+            text.id
+            for text in document_texts
+            if text.is_active and text.hash not in chunks_by_hash
+        ]
+        # Texts of the outdated documents are taken over too: they are only
+        # deactivated below, in the same transaction
+        outdated_document_ids = set(data.get("outdated_document_ids", []))
+        restored_ids = [
+            text.id
+            for text in existing_texts
+            if (text.document_id == document_id and not text.is_active)
+            or (
+                text.document_id != document_id
+                and (
+                    text.document_id in outdated_document_ids
+                    or not text.document.is_active
+                )
+            )
+        ]
+        restored_id_set = set(restored_ids)
+
+        # Texts kept in the document follow the chunks' current order
+        positions = []
+
+        for text in existing_texts:
+            if text.document_id != document_id and text.id not in restored_id_set:
+                continue
+
+            chunk = chunks_by_hash[text.hash]
+
+            if (text.position, text.start_offset, text.end_offset) != (
+                chunk["position"],
+                chunk["start_offset"],
+                chunk["end_offset"],
+            ):
+                positions.append(
+                    {
+                        "id": text.id,
+                        "position": chunk["position"],
+                        "start_offset": chunk["start_offset"],
+                        "end_offset": chunk["end_offset"],
+                    }
+                )
+
+        crud.update_texts_active_status(
+            self.session, removed_ids, is_active=False, commit=False
+        )
+        crud.move_texts_to_document(
+            self.session, restored_ids, document_id, commit=False
+        )
+        crud.update_text_positions(self.session, positions, commit=False)
+        crud.bulk_create_texts(self.session, insert_data, commit=False)
+
+        for outdated_id in outdated_document_ids:
+            crud.update_document_active_status(
+                self.session, outdated_id, is_active=False
+            )
+            logger.info(f"deactivated outdated document [{outdated_id}]")
+
+        if data.get("hash"):
+            crud.update_document_content(
+                self.session,
+                document_id,
+                data["hash"],
+                data.get("content"),
+                commit=False,
+            )
 
-        logger.info(f"[{data.get('filename')}] [{len(insert_data)}] embeddings saved!")
+        return {
+            "inserted": len(insert_data),
+            "deactivated": len(removed_ids),
+            "reactivated": len(restored_ids),
+        }
 
     @staticmethod
     def _pack_data(text: schema.Text, similarity: float) -> dict:
         return {
             "id": text.id,
+            "document_id": text.document_id,
             "filename": text.document.filename,
             "name": text.document.name,
             "content": text.content,
+            "position": text.position,
+            "start_offset": text.start_offset,
+            "end_offset": text.end_offset,
             "cosine_similarity": similarity,
         }
 
+    def _active_texts(self, search_filter: Optional[SearchFilter] = None) -> list:
+        document_ids = None
+
+        if search_filter is not None:
+            document_ids = [
+                document.id
+                for document in crud.get_all_active_documents(self.session)
+                if search_filter.matches(document_record(document))
+            ]
+
+        return crud.get_active_texts_from_active_documents(self.session, document_ids)
+
     @helpers.measure_time
-    def _fetch_results(self, query: str, active_texts: Optional[list] = None) -> list:
-        query_embedding = self.model.encode(query)
+    def _fetch_results(
+        self,
+        query: str,
+        active_texts: Optional[list] = None,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> list:
+        query_embedding = self.encode_query(query)
 
         if active_texts is None:
-            active_texts = crud.get_active_texts_from_active_documents(self.session)
+            active_texts = self._active_texts(search_filter)
+
+        if not active_texts:
+            return []
 
         document_embeddings = np.stack(
             [np.frombuffer(text.embedding, dtype=np.float32) for text in active_texts]
@@ -147,42 +429,104 @@ class Embeddings:
 
         return results
 
-    @helpers.measure_time
+    @helpers.measure_time(stage="rerank")
     def _rerank_results(
-        self, query: str, results: list, rerank_top_k: int = 5, threshold: float = -5.0
+        self,
+        query: str,
+        results: list,
+        rerank_top_k: int = settings.RERANK_TOP_K,
+        threshold: float = settings.RERANK_THRESHOLD,
+        batch_size: int = settings.RERANK_BATCH_SIZE,
+        patience: int = settings.RERANK_PATIENCE,
+        score_gap: float = settings.RERANK_SCORE_GAP,
     ) -> list:
-        logger.info("reranking results...")
+        """
+        Reranking cascade: the results, sorted by their first-stage score, are
+        scored in batches, stopping early once the top-k has been stable for
+        `patience` batches or the next batch trails the best first-stage score
+        by more than `score_gap`.
+        """
+        logger.info(f"reranking [{len(results)}] candidates...")
+        scored_results = []
+        previous_top_ids = None
+        stable_batches = 0
+
+        for start in range(0, len(results), batch_size):
+            batch = results[start : start + batch_size]
+            first_stage_gap = (
+                results[0]["cosine_similarity"] - batch[0]["cosine_similarity"]
+            )
+
+            if scored_results and first_stage_gap > score_gap:
+                logger.info(f"first-stage score gap reached after [{start}] candidates")
+                break
+
+            scores = self.cross_encoder.predict(
+                [(query, result["content"]) for result in batch]
+            )
+
+            for result, score in zip(batch, scores):
+                result["rerank_score"] = float(score)
+                scored_results.append(result)
 
-        query_document_pairs = [(query, result["content"]) for result in results]
-        scores = self.cross_encoder.predict(query_document_pairs)
+            top_ids = [
+                result["id"]
+                for result in heapq.nlargest(
+                    rerank_top_k, scored_results, key=itemgetter("rerank_score")
+                )
+            ]
+            stable_batches = stable_batches + 1 if top_ids == previous_top_ids else 0
+            previous_top_ids = top_ids
 
-        for result, score in zip(results, scores):
-            result["rerank_score"] = score
+            if stable_batches >= patience:
+                logger.info(f"top-k stable after [{len(scored_results)}] candidates")
+                break
 
         filtered_results = [
-            result for result in results if result["rerank_score"] >= threshold
+            result for result in scored_results if result["rerank_score"] >= threshold
         ]
         logger.info("done!")
-        return sorted(filtered_results, key=lambda x: x["rerank_score"], reverse=True)[
-            :rerank_top_k
-        ]
+
+        return heapq.nlargest(
+            rerank_top_k, filtered_results, key=itemgetter("rerank_score")
+        )
 
     @helpers.measure_time
-    def retrieve(self, query: str, top_k: int = 5, rerank: bool = False) -> list:
+    def retrieve(
+        self,
+        query: str,
+        top_k: int = 5,
+        rerank: bool = False,
+        candidates: int = settings.RERANK_CANDIDATES,
+        timings: Optional[dict] = None,
+        search_filter: Optional[SearchFilter] = None,
+    ) -> list:
         logger.info(f"search the results for [{query}]")
-        results = self._fetch_results(query)
-        results = sorted(
-            results, key=lambda x: x.get("cosine_similarity"), reverse=True
-        )[:top_k]
+        timings = {} if timings is None else timings
+        pool_size = max(top_k, candidates) if rerank else top_k
+        corpus = self.corpus
+
+        start_time = time.perf_counter()
+
+        if corpus is not None:
+            results = corpus.search(self.encode_query(query), pool_size, search_filter)
+        else:
+            results = self._fetch_results(query, search_filter=search_filter)
+            results = sorted(
+                results, key=lambda x: x.get("cosine_similarity"), reverse=True
+            )[:pool_size]
+
+        timings["first_stage"] = time.perf_counter() - start_time
 
         if rerank:
-            results = self._rerank_results(query, results)
+            start_time = time.perf_counter()
+            results = self._rerank_results(query, results, rerank_top_k=top_k)
+            timings["rerank"] = time.perf_counter() - start_time
 
         logger.info("search done!")
 
         return results
 
-    @helpers.measure_time
     def _get_synonyms(self, token: str) -> str:
         return self.wordnet_syn.get_synonyms(token)
 
@@ -202,6 +546,49 @@ class Embeddings:
 
         return expanded_query
 
+    def _fts_scores(
+        self,
+        corpus: Corpus,
+        query_tokens: list[str],
+        rows: Optional[np.ndarray],
+        search_filter: Optional[SearchFilter] = None,
+    ) -> np.ndarray:
+        """
+        Lexical scores aligned with the searched rows, from the FTS5 index. Only
+        the best candidates are scored, the other rows get 0, as do texts not
+        in the corpus snapshot yet.
+        """
+        document_ids = None
+
+        if search_filter is not None:
+            document_ids = [
+                document_id
+                for document_id, document in corpus.documents.items()
+                if search_filter.matches(document)
+            ]
+
+        matches = crud.search_texts_fts(
+            self.session, query_tokens, document_ids=document_ids
+        )
+        scores = np.zeros(len(corpus) if rows is None else len(rows), dtype=np.float32)
+
+        if not matches:
+            return scores
+
+        text_ids, match_scores = zip(*matches)
+        positions = corpus.rows_of(text_ids)
+        match_scores = np.asarray(match_scores, dtype=np.float32)
+
+        if rows is not None:
+            # The searched rows are in ascending order
+            indices = np.minimum(np.searchsorted(rows, positions), len(rows) - 1)
+            positions = np.where(rows[indices] == positions, indices, -1)
+
+        found = positions >= 0
+        scores[positions[found]] = match_scores[found]
+
+        return scores
+
     @helpers.measure_time
     def retrieve_hybrid(
         self,
@@ -211,28 +598,61 @@ class Embeddings:
         bm25_weight: float = settings.BM25_SEARCH_WEIGHT,
         embedding_weight: float = settings.EMBEDDINGS_SEARCH_WEIGHT,
         rerank: bool = False,
-        rerank_top_k: int = 5,
+        rerank_top_k: int = settings.RERANK_TOP_K,
+        candidates: int = settings.RERANK_CANDIDATES,
+        timings: Optional[dict] = None,
+        search_filter: Optional[SearchFilter] = None,
     ) -> list:
         logger.info("performing hybrid search...")
+        timings = {} if timings is None else timings
+        pool_size = max(top_k, candidates) if rerank else top_k
+        start_time = time.perf_counter()
 
         if wordnetsyn_instance:
             self.wordnet_syn = wordnetsyn_instance
 
         expanded_query = self.expand_query(query)
-        active_texts = crud.get_active_texts_from_active_documents(self.session)
-
-        corpus = [text.content for text in active_texts]
-        tokenized_corpus = [word.split() for word in corpus]
-        bm25 = BM25Okapi(tokenized_corpus)
         query_tokens = expanded_query.split()
-        bm25_scores = bm25.get_scores(query_tokens)
-
-        embedding_scores = np.array(
-            [
-                result.get("cosine_similarity")
-                for result in self._fetch_results(query, active_texts)
-            ]
-        )
+        corpus = self.corpus
+
+        if corpus is not None:
+            ranges = corpus.ranges(search_filter)
+            rows = None if ranges is None else corpus.rows_in(ranges)
+
+            if not len(corpus) or (rows is not None and not len(rows)):
+                return []
+
+            with metrics.timer("bm25"):
+                if settings.LEXICAL_BACKEND == "fts5":
+                    bm25_scores = self._fts_scores(
+                        corpus, query_tokens, rows, search_filter
+                    )
+                elif rows is None:
+                    bm25_scores = corpus.bm25.get_scores(query_tokens)
+                else:
+                    bm25_scores = np.array(
+                        corpus.bm25.get_batch_scores(query_tokens, rows.tolist())
+                    )
+
+            embedding_scores = corpus.scores(self.encode_query(query), ranges)
+        else:
+            active_texts = self._active_texts(search_filter)
+
+            if not active_texts:
+                return []
+
+            tokenized_corpus = [text.content.split() for text in active_texts]
+
+            with metrics.timer("bm25"):
+                bm25 = BM25Okapi(tokenized_corpus)
+                bm25_scores = bm25.get_scores(query_tokens)
+
+            embedding_scores = np.array(
+                [
+                    result.get("cosine_similarity")
+                    for result in self._fetch_results(query, active_texts)
+                ]
+            )
 
         normalized_bm25 = helpers.normalize(bm25_scores)
         normalized_embedding = helpers.normalize(embedding_scores)
@@ -241,17 +661,30 @@ class Embeddings:
             bm25_weight * normalized_bm25 + embedding_weight * normalized_embedding
         )
 
-        results = []
+        if corpus is not None:
+            best = helpers.top_k_indices(hybrid_scores, pool_size)
+            results = corpus.pack(
+                best if rows is None else rows[best], hybrid_scores[best]
+            )
+        else:
+            results = []
+
+            for text, score in zip(active_texts, hybrid_scores):
+                results.append(self._pack_data(text, score))
 
-        for text, score in zip(active_texts, hybrid_scores):
-            results.append(self._pack_data(text, score))
+            results = sorted(
+                results, key=lambda x: x.get("cosine_similarity"), reverse=True
+            )[:pool_size]
 
-        results = sorted(
-            results, key=lambda x: x.get("cosine_similarity"), reverse=True
-        )[:top_k]
+        timings["first_stage"] = time.perf_counter() - start_time
 
         if rerank:
-            results = self._rerank_results(query, results)[:rerank_top_k]
+            start_time = time.perf_counter()
+            # Never more than top_k, as when no rerank happens
+            results = self._rerank_results(
+                query, results, rerank_top_k=min(top_k, rerank_top_k)
+            )
+            timings["rerank"] = time.perf_counter() - start_time
 
         logger.info("hybrid search done!")
 
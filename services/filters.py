@@ -0,0 +1,80 @@
+from fnmatch import fnmatch
+
+from models import schema
+
+
+SCALARS = (str, int, float, bool, type(None))
+
+
+def _is_list_of(value, item_type: type) -> bool:
+    # bool is an int subclass, but `true` isn't a document id
+    return isinstance(value, list) and all(
+        isinstance(item, item_type) and not isinstance(item, bool) for item in value
+    )
+
+
+def document_record(document: schema.Document) -> dict:
+    return {"id": document.id, "filename": document.filename, "name": document.name}
+
+
+class SearchFilter:
+    """
+    Restricts a search to the documents matching every given criterion:
+    document ids, filename patterns (fnmatch-style, e.g. "*graduacao*") and
+    exact values for any other document attribute carried in the records.
+    """
+
+    def __init__(
+        self,
+        document_ids: list[int] | None = None,
+        filenames: list[str] | None = None,
+        metadata: dict | None = None,
+    ):
+        self.document_ids = set(document_ids) if document_ids is not None else None
+        self.filenames = filenames or []
+        self.metadata = metadata or {}
+
+    @classmethod
+    def from_dict(cls, data: dict | None) -> "SearchFilter | None":
+        """
+        Builds the filter from a request's `filters`, raising ValueError when
+        it isn't shaped as documented.
+        """
+        if not data:
+            return None
+
+        if not isinstance(data, dict):
+            raise ValueError("filters must be an object")
+
+        document_ids = data.get("document_ids")
+        filenames = data.get("filenames")
+        metadata = data.get("metadata")
+
+        if document_ids is not None and not _is_list_of(document_ids, int):
+            raise ValueError("filters.document_ids must be a list of integers")
+
+        if filenames is not None and not _is_list_of(filenames, str):
+            raise ValueError("filters.filenames must be a list of strings")
+
+        if metadata is not None and not (
+            isinstance(metadata, dict)
+            and all(isinstance(value, SCALARS) for value in metadata.values())
+        ):
+            raise ValueError("filters.metadata must be an object of scalar values")
+
+        return cls(
+            document_ids=document_ids,
+            filenames=filenames,
+            metadata=metadata,
+        )
+
+    def matches(self, document: dict) -> bool:
+        if self.document_ids is not None and document["id"] not in self.document_ids:
+            return False
+
+        if self.filenames and not any(
+            fnmatch(document["filename"], pattern) for pattern in self.filenames
+        ):
+            return False
+
+        return all(document.get(key) == value for key, value in self.metadata.items())
@@ -0,0 +1,255 @@
+import argparse
+import os
+import shutil
+
+import numpy as np
+import torch
+
+from sentence_transformers import SentenceTransformer, CrossEncoder
+
+import settings
+
+from utils.logging import logger
+
+
+def _export_path(model_name: str) -> str:
+    return os.path.join(settings.ONNX_CACHE_DIR, model_name.replace("/", "__"))
+
+
+def _export(path: str, save) -> None:
+    """
+    Runs `save` on a temporary directory that replaces `path` once complete,
+    so an interrupted export is redone on the next start instead of loaded.
+    """
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(temporary_path, ignore_errors=True)
+    save(temporary_path)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temporary_path, path)
+
+
+def _session_options():
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = settings.INFERENCE_THREADS
+    options.inter_op_num_threads = 1
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    return options
+
+
+def _check_backend(backend: str) -> None:
+    if backend not in ("torch", "onnx"):
+        raise ValueError(f"unknown inference backend: [{backend}]")
+
+    if backend == "torch":
+        torch.set_num_threads(settings.INFERENCE_THREADS)
+
+
+def load_embedder(backend: str = settings.INFERENCE_BACKEND) -> SentenceTransformer:
+    _check_backend(backend)
+    logger.info(f"loading [{settings.EMBEDDINGS_MODEL}] with the [{backend}] backend")
+
+    if backend == "torch":
+        return SentenceTransformer(settings.EMBEDDINGS_MODEL)
+
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+
+    path = _export_path(settings.EMBEDDINGS_MODEL)
+    base_file_name = "onnx/model.onnx"
+    quantized_file_name = f"onnx/model_qint8_{settings.ONNX_QUANTIZATION_CONFIG}.onnx"
+
+    # The files are checked, not the directory: the quantization settings may
+    # have changed since the export
+    if not os.path.isfile(os.path.join(path, base_file_name)):
+        logger.info(f"exporting [{settings.EMBEDDINGS_MODEL}] to ONNX at [{path}]...")
+        _export(
+            path,
+            SentenceTransformer(
+                settings.EMBEDDINGS_MODEL, backend="onnx"
+            ).save_pretrained,
+        )
+
+    if settings.ONNX_QUANTIZE and not os.path.isfile(
+        os.path.join(path, quantized_file_name)
+    ):
+        logger.info(f"quantizing [{path}] for [{settings.ONNX_QUANTIZATION_CONFIG}]...")
+        # Written to a temporary directory and then moved into place
+        export_dynamic_quantized_onnx_model(
+            SentenceTransformer(
+                path, backend="onnx", model_kwargs={"file_name": base_file_name}
+            ),
+            settings.ONNX_QUANTIZATION_CONFIG,
+            path,
+        )
+
+    model_kwargs = {
+        "file_name": quantized_file_name if settings.ONNX_QUANTIZE else base_file_name,
+        "provider": "CPUExecutionProvider",
+        "session_options": _session_options(),
+    }
+
+    return SentenceTransformer(path, backend="onnx", model_kwargs=model_kwargs)
+
+
+class ONNXCrossEncoder:
+    """
+    ONNX Runtime counterpart of `CrossEncoder`, exposing the same `predict`
+    interface. The installed sentence-transformers only exports bi-encoders,
+    so the export and quantization are done through optimum directly.
+    """
+
+    def __init__(self, model_name: str, quantize: bool = settings.ONNX_QUANTIZE):
+        from optimum.onnxruntime import (
+            ORTModelForSequenceClassification,
+            ORTQuantizer,
+        )
+        from optimum.onnxruntime.configuration import AutoQuantizationConfig
+        from transformers import AutoTokenizer
+
+        path = _export_path(model_name)
+        base_file_name = "model.onnx"
+        quantized_file_name = f"model_qint8_{settings.ONNX_QUANTIZATION_CONFIG}.onnx"
+        file_name = quantized_file_name if quantize else base_file_name
+
+        def save(directory: str) -> None:
+            ORTModelForSequenceClassification.from_pretrained(
+                model_name, export=True
+            ).save_pretrained(directory)
+            AutoTokenizer.from_pretrained(model_name).save_pretrained(directory)
+
+        if not os.path.isfile(os.path.join(path, base_file_name)):
+            logger.info(f"exporting [{model_name}] to ONNX at [{path}]...")
+            _export(path, save)
+
+        if quantize and not os.path.isfile(os.path.join(path, quantized_file_name)):
+            logger.info(
+                f"quantizing [{path}] for [{settings.ONNX_QUANTIZATION_CONFIG}]..."
+            )
+            quantization_config = getattr(
+                AutoQuantizationConfig, settings.ONNX_QUANTIZATION_CONFIG
+            )(is_static=False, per_channel=False)
+            temporary_path = f"{path}.{os.getpid()}.quantized.tmp"
+            ORTQuantizer.from_pretrained(path, file_name=base_file_name).quantize(
+                save_dir=temporary_path, quantization_config=quantization_config
+            )
+            os.replace(
+                os.path.join(temporary_path, "model_quantized.onnx"),
+                os.path.join(path, quantized_file_name),
+            )
+            shutil.rmtree(temporary_path, ignore_errors=True)
+
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+        self.model = ORTModelForSequenceClassification.from_pretrained(
+            path,
+            file_name=file_name,
+            provider="CPUExecutionProvider",
+            session_options=_session_options(),
+        )
+        self.num_labels = self.model.config.num_labels
+
+    def predict(self, sentences: list, batch_size: int = 32, **kwargs) -> np.ndarray:
+        batches = []
+
+        for start in range(0, len(sentences), batch_size):
+            batch = sentences[start : start + batch_size]
+            features = self.tokenizer(
+                [pair[0] for pair in batch],
+                [pair[1] for pair in batch],
+                padding=True,
+                truncation=True,
+                return_tensors="np",
+            )
+            batches.append(self.model(**features).logits)
+
+        if not batches:
+            return np.empty(0, dtype=np.float32)
+
+        logits = np.concatenate(batches)
+
+        if self.num_labels == 1:
+            # Same default activation applied by CrossEncoder for single-label models
+            return 1 / (1 + np.exp(-logits[:, 0]))
+
+        return logits
+
+
+def load_cross_encoder(backend: str = settings.INFERENCE_BACKEND):
+    _check_backend(backend)
+    logger.info(f"loading [{settings.CROSSENCODER_MODEL}] with the [{backend}] backend")
+
+    if backend == "torch":
+        return CrossEncoder(settings.CROSSENCODER_MODEL)
+
+    return ONNXCrossEncoder(settings.CROSSENCODER_MODEL)
+
+
+def _top_k_agreement(reference: np.ndarray, candidate: np.ndarray, top_k: int):
+    reference_order = np.argsort(-reference, kind="stable")[:top_k]
+    candidate_order = np.argsort(-candidate, kind="stable")[:top_k]
+    overlap = len(set(reference_order) & set(candidate_order)) / len(reference_order)
+
+    return overlap, bool(np.array_equal(reference_order, candidate_order))
+
+
+def _parity_metrics(reference: np.ndarray, candidate: np.ndarray, top_k: int):
+    agreements = [
+        _top_k_agreement(reference_row, candidate_row, top_k)
+        for reference_row, candidate_row in zip(reference, candidate)
+    ]
+
+    return {
+        "top_k_overlap": float(np.mean([overlap for overlap, _ in agreements])),
+        "same_order_ratio": float(np.mean([same for _, same in agreements])),
+        "max_abs_diff": float(np.max(np.abs(reference - candidate))),
+    }
+
+
+def check_parity(queries: list[str], documents: list[str], top_k: int = 5) -> dict:
+    """
+    Compares the ONNX backend against the PyTorch one on the same inputs,
+    reporting how much of the cosine and rerank top-k orderings is preserved.
+    """
+    similarities = {}
+    rerank_scores = {}
+    pairs = [(query, document) for query in queries for document in documents]
+
+    for backend in ("torch", "onnx"):
+        model = load_embedder(backend)
+        query_embeddings = model.encode(queries, normalize_embeddings=True)
+        document_embeddings = model.encode(documents, normalize_embeddings=True)
+        similarities[backend] = query_embeddings @ document_embeddings.T
+
+        scores = load_cross_encoder(backend).predict(pairs)
+        rerank_scores[backend] = np.asarray(scores).reshape(len(queries), -1)
+
+    return {
+        "embedder": _parity_metrics(similarities["torch"], similarities["onnx"], top_k),
+        "cross_encoder": _parity_metrics(
+            rerank_scores["torch"], rerank_scores["onnx"], top_k
+        ),
+    }
+
+
+if __name__ == "__main__":
+    from models import crud
+    from models.database import session
+
+    parser = argparse.ArgumentParser(
+        description="Checks that the ONNX backend preserves the PyTorch rankings."
+    )
+    parser.add_argument("queries", nargs="+")
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--min-overlap", type=float, default=0.9)
+    args = parser.parse_args()
+
+    texts = crud.get_active_texts_from_active_documents(session)[: args.documents]
+    report = check_parity(args.queries, [text.content for text in texts], args.top_k)
+
+    for stage, metrics in report.items():
+        print(stage, " ".join(f"{key}={value:.4f}" for key, value in metrics.items()))
+
+    if any(metrics["top_k_overlap"] < args.min_overlap for metrics in report.values()):
+        raise SystemExit(1)
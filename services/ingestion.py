@@ -0,0 +1,214 @@
+import argparse
+import glob
+import os
+import threading
+
+from sqlalchemy.orm import Session
+
+import settings
+
+from models import crud, schema
+from services import text_processing
+from utils import helpers
+from utils.logging import logger
+
+
+def job_record(job: schema.IngestionJob) -> dict:
+    return {
+        "id": job.id,
+        "filepath": job.filepath,
+        "status": job.status,
+        "error": job.error,
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "updated_at": job.updated_at.isoformat() if job.updated_at else None,
+    }
+
+
+def submit(
+    session: Session, filepath: str, allowed_dir: str | None = None
+) -> schema.IngestionJob:
+    """
+    Enqueues a PDF for ingestion. With `allowed_dir`, which the API always
+    sets, paths resolving outside of that directory are refused.
+    """
+    filepath = os.path.realpath(filepath)
+
+    if allowed_dir is not None:
+        allowed_dir = os.path.realpath(allowed_dir)
+
+        if os.path.commonpath([filepath, allowed_dir]) != allowed_dir:
+            raise ValueError(f"[{filepath}] is outside of [{allowed_dir}]")
+
+    if not filepath.lower().endswith(".pdf"):
+        raise ValueError(f"[{filepath}] is not a PDF file")
+
+    if not os.path.isfile(filepath):
+        raise ValueError(f"[{filepath}] does not exist")
+
+    job = crud.create_ingestion_job(session, filepath)
+    logger.info(f"ingestion job [{job.id}] created for [{filepath}]")
+
+    return job
+
+
+def submit_directory(session: Session, path: str = settings.INGEST_DIR) -> list:
+    """
+    Enqueues the PDFs in `path` that are neither stored nor already queued.
+    """
+    known_hashes = crud.get_all_document_hashes(session)
+    queued_filepaths = crud.get_pending_ingestion_filepaths(session)
+    jobs = []
+
+    for pdf_path in glob.glob(os.path.join(path, "*.pdf")):
+        pdf_path = os.path.realpath(pdf_path)
+
+        if pdf_path in queued_filepaths:
+            continue
+
+        if helpers.generate_hash_from_file(pdf_path) in known_hashes:
+            continue
+
+        jobs.append(submit(session, pdf_path))
+
+    return jobs
+
+
+class IngestionWorker:
+    """
+    Background thread consuming the ingestion jobs and keeping the embedder's
+    corpus up to date. Under gunicorn every worker runs one: the jobs are
+    claimed atomically, so each is processed once, and every worker reloads
+    its snapshot when the number of finished jobs (the corpus version) changes.
+    """
+
+    def __init__(
+        self,
+        session: Session,
+        embedder,
+        poll_interval: float = settings.INGEST_POLL_INTERVAL,
+        stale_after: float = settings.INGEST_STALE_AFTER,
+    ):
+        self.session = session
+        self.embedder = embedder
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.version = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> None:
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="ingestion-worker", daemon=True
+        )
+        self._thread.start()
+        logger.info("ingestion worker started")
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self) -> None:
+        try:
+            while not self._stop.is_set():
+                try:
+                    processed = self.run_once()
+                except Exception as exc:
+                    self.session.rollback()
+                    logger.error(f"ingestion worker error: {str(exc)}", exc_info=True)
+                    processed = False
+
+                if not processed:
+                    self._stop.wait(self.poll_interval)
+        finally:
+            self.session.remove()
+
+    def run_once(self) -> bool:
+        """
+        Processes the next pending job, or refreshes the corpus when there is
+        none. Returns whether a job was processed.
+        """
+        crud.requeue_stale_ingestion_jobs(self.session, self.stale_after)
+        job = crud.claim_next_ingestion_job(self.session)
+
+        if job is None:
+            # The chunking processes are only kept while there are jobs
+            self.embedder.close_chunking_processes()
+            self.refresh()
+            return False
+
+        self.process(job)
+        self.refresh()
+
+        return True
+
+    @helpers.measure_time
+    def process(self, job: schema.IngestionJob) -> None:
+        logger.info(f"processing ingestion job [{job.id}]: [{job.filepath}]")
+
+        try:
+            data = text_processing.parse_pdf(self.session, job.filepath)
+
+            if data:
+                self.embedder.process_data(data)
+        except Exception as exc:
+            self.session.rollback()
+            crud.update_ingestion_job_status(self.session, job.id, "failed", str(exc))
+            logger.error(f"ingestion job [{job.id}] failed: {str(exc)}", exc_info=True)
+            return
+
+        crud.update_ingestion_job_status(self.session, job.id, "done")
+        logger.info(f"ingestion job [{job.id}] done")
+
+    def refresh(self) -> None:
+        # The version is read before loading: a job finishing meanwhile only
+        # triggers one more reload, instead of being missed
+        version = crud.count_finished_ingestion_jobs(self.session)
+
+        if version == self.version:
+            return
+
+        logger.info(f"corpus version changed [{self.version} -> {version}]")
+        self.embedder.load_corpus()
+        self.version = version
+
+
+if __name__ == "__main__":
+    from models import database
+    from models.database import session
+
+    parser = argparse.ArgumentParser(description="Manages the ingestion jobs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    submit_parser = subparsers.add_parser("submit", help="enqueues PDF files")
+    submit_parser.add_argument("files", nargs="+")
+    status_parser = subparsers.add_parser("status", help="shows the jobs' status")
+    status_parser.add_argument("job_ids", nargs="+", type=int)
+    args = parser.parse_args()
+
+    database.Base.metadata.create_all(bind=database.engine)
+    database.migrate()
+
+    if args.command == "submit":
+        for filepath in args.files:
+            try:
+                job = submit(session, filepath)
+            except ValueError as exc:
+                print(f"error: {exc}")
+                continue
+
+            print(job.id, job.filepath)
+
+    elif args.command == "status":
+        for job_id in args.job_ids:
+            job = crud.get_ingestion_job_by_id(session, job_id)
+
+            if job is None:
+                print(job_id, "not found")
+                continue
+
+            print(job.id, job.status, job.filepath, job.error or "")
@@ -1,17 +1,16 @@
 import faiss
-import heapq
 import networkx as nx
 import numpy as np
 
-from operator import itemgetter
 from sqlalchemy.orm import Session
 from sklearn.metrics.pairwise import cosine_similarity
 
 import settings
 
 from services import embeddings
+from services.filters import SearchFilter, document_record
 from models import crud
-from utils import helpers
+from utils import helpers, metrics
 from utils.logging import logger
 
 
@@ -26,6 +25,8 @@ class FAISSIndex:
         self.embedder = embedder
         self.dimension = dimension
         self.index = None
+        self.documents = {}
+        self.document_texts = {}
 
     @helpers.measure_time
     def build_index(self):
@@ -33,6 +34,8 @@ class FAISSIndex:
         texts = crud.get_texts_from_active_documents(self.session)
         embeddings = []
         document_ids = []
+        documents = {}
+        document_texts = {}
 
         for text in texts:
             embedding = np.frombuffer(text.embedding, dtype=np.float32)
@@ -43,6 +46,8 @@ class FAISSIndex:
 
             embeddings.append(embedding)
             document_ids.append(text.id)
+            documents.setdefault(text.document_id, document_record(text.document))
+            document_texts.setdefault(text.document_id, []).append(text.id)
 
         embeddings = np.vstack(embeddings).astype(np.float32)
 
@@ -50,46 +55,66 @@ class FAISSIndex:
         self.index = faiss.IndexIDMap(index_flat)
         id_array = np.array(document_ids, dtype=np.int64)
         self.index.add_with_ids(embeddings, id_array)
+        self.documents = documents
+        self.document_texts = {
+            document_id: np.array(text_ids, dtype=np.int64)
+            for document_id, text_ids in document_texts.items()
+        }
 
         logger.info(f"FAISS index built: {self.index.ntotal} vectors")
 
     @helpers.measure_time
     def _rerank(
-        self, query: str, results: list, rerank_top_k: int = 5, threshold: float = -5.0
+        self,
+        query: str,
+        results: list,
+        rerank_top_k: int = settings.RERANK_TOP_K,
+        threshold: float = settings.RERANK_THRESHOLD,
     ) -> list:
-        logger.info("reranking results...")
-        filtered_results = []
-
-        query_document_pairs = [(query, result["content"]) for result in results]
-        scores = self.embedder.cross_encoder.predict(query_document_pairs)
-
-        for result, score in zip(results, scores):
-            result["rerank_score"] = score
-
-            if score >= threshold:
-                filtered_results.append(result)
-
-        final_results = heapq.nlargest(
-            rerank_top_k, filtered_results, key=itemgetter("rerank_score")
+        return self.embedder._rerank_results(
+            query, results, rerank_top_k=rerank_top_k, threshold=threshold
         )
-        logger.info("done!")
-
-        return final_results
 
     @helpers.measure_time
     def search(
-        self, query: str, top_k: int = 5, rerank: bool = False, rerank_top_k: int = 5
+        self,
+        query: str,
+        top_k: int = 5,
+        rerank: bool = False,
+        rerank_top_k: int = settings.RERANK_TOP_K,
+        candidates: int = settings.RERANK_CANDIDATES,
+        search_filter: SearchFilter | None = None,
     ) -> list:
         logger.info(f"search for [{query}] via FAISS...")
+        pool_size = max(top_k, candidates) if rerank else top_k
+        search_parameters = None
+
+        if search_filter is not None:
+            selected_ids = [
+                self.document_texts[document_id]
+                for document_id, document in self.documents.items()
+                if search_filter.matches(document)
+            ]
+
+            if not selected_ids:
+                return []
 
-        query_embedding = self.embedder.model.encode(query)
+            search_parameters = faiss.SearchParameters(
+                sel=faiss.IDSelectorBatch(np.concatenate(selected_ids))
+            )
+
+        query_embedding = self.embedder.encode_query(query)
         norm = np.linalg.norm(query_embedding)
 
         if norm > 1e-6:
             query_embedding = query_embedding / norm
 
         query_embedding = np.expand_dims(query_embedding, axis=0).astype(np.float32)
-        distances, retrieved_ids = self.index.search(query_embedding, top_k)
+
+        with metrics.timer("scan"):
+            distances, retrieved_ids = self.index.search(
+                query_embedding, pool_size, params=search_parameters
+            )
 
         valid_ids = [
             int(document_id) for document_id in retrieved_ids[0] if document_id != -1
@@ -110,7 +135,8 @@ class FAISSIndex:
                 results.append(self.embedder._pack_data(text_object, float(score)))
 
         if rerank:
-            results = self._rerank(query, results, rerank_top_k)
+            # Never more than top_k, as when no rerank happens
+            results = self._rerank(query, results, min(top_k, rerank_top_k))
 
         logger.info("done!")
 
@@ -162,14 +188,36 @@ class Graph:
             f"graph built with [{self.graph.number_of_nodes()}] nodes and [{self.graph.number_of_edges()}] edges!"
         )
 
+    def _node_matches(self, node_id: int, search_filter: SearchFilter) -> bool:
+        node = self.graph.nodes[node_id]
+
+        return search_filter.matches(
+            {
+                "id": node["document_id"],
+                "filename": node["filename"],
+                "name": node["name"],
+            }
+        )
+
     @helpers.measure_time
-    def retrieve(self, query: str, top_k: int = 5, graph_expansion_steps: int = 1):
+    def retrieve(
+        self,
+        query: str,
+        top_k: int = 5,
+        graph_expansion_steps: int = 1,
+        search_filter: SearchFilter | None = None,
+    ):
         logger.info("retrieving information for the graph network...")
-        query_embedding = self.embedder.model.encode(query)
+        query_embedding = self.embedder.encode_query(query)
         active_texts = crud.get_texts_from_active_documents(self.session)
         results = []
 
         for text in active_texts:
+            if search_filter and not search_filter.matches(
+                document_record(text.document)
+            ):
+                continue
+
             embedding = np.frombuffer(text.embedding, dtype=np.float32)
             similarity = cosine_similarity([query_embedding], [embedding])[0][0]
             results.append((text.id, similarity))
@@ -187,7 +235,11 @@ class Graph:
             neighbors = set()
 
             for node in list(expanded_nodes):
-                neighbors.update(self.graph.neighbors(node))
+                neighbors.update(
+                    neighbor
+                    for neighbor in self.graph.neighbors(node)
+                    if not search_filter or self._node_matches(neighbor, search_filter)
+                )
 
             expanded_nodes.update(neighbors)
 
@@ -0,0 +1,201 @@
+import atexit
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import get_context
+
+import numpy as np
+
+import settings
+
+from utils import helpers
+from utils.logging import logger
+
+
+def _serve_shard(connection, embeddings_path: str, start: int, end: int) -> None:
+    embeddings = np.load(embeddings_path, mmap_mode="r")[start:end]
+
+    while True:
+        message = connection.recv()
+
+        if message is None:
+            break
+
+        query_embedding, top_k, ranges = message
+
+        if ranges is None:
+            rows = None
+            scores = embeddings @ query_embedding
+        else:
+            rows = np.concatenate([np.arange(a, b) for a, b in ranges])
+            scores = np.concatenate(
+                [embeddings[a:b] @ query_embedding for a, b in ranges]
+            )
+
+        if top_k is None:
+            # Every score of the shard's rows, for the hybrid search's fusion
+            connection.send(scores)
+            continue
+
+        best = helpers.top_k_indices(scores, top_k)
+        local_rows = best if rows is None else rows[best]
+        connection.send((local_rows + start, scores[best]))
+
+    connection.close()
+
+
+class ShardedSearcher:
+    """
+    Splits the corpus rows into `shards` contiguous partitions, each scanned by
+    its own worker process over the snapshot's memory-mapped embedding matrix.
+    Queries are fanned out to every shard in parallel and the partial top-k
+    lists are merged, or, for the hybrid search, the full score slices are
+    concatenated. The workers are started lazily by the process that first
+    searches, so each forked server worker gets its own set.
+    """
+
+    def __init__(self, embeddings_path: str, size: int, shards: int):
+        self.embeddings_path = embeddings_path
+        bounds = np.linspace(0, size, shards + 1, dtype=np.int64)
+        self.bounds = [
+            (int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        self._pid = None
+        self._connections = []
+        self._processes = []
+        self._locks = []
+        self._executor = None
+        self._start_lock = threading.Lock()
+
+    @classmethod
+    def from_corpus(
+        cls, corpus, shards: int = settings.SEARCH_SHARDS
+    ) -> "ShardedSearcher":
+        """
+        The shard workers map the corpus snapshot's own file, which is named
+        after its contents: a searcher still starting its workers never maps a
+        different matrix than its own.
+        """
+        logger.info(f"corpus sharded in [{shards}] partitions")
+
+        return cls(corpus.embeddings_path, len(corpus), shards)
+
+    def _start(self) -> None:
+        context = get_context("spawn")
+        self._connections, self._processes, self._locks = [], [], []
+
+        for start, end in self.bounds:
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(
+                target=_serve_shard,
+                args=(child_connection, self.embeddings_path, start, end),
+                daemon=True,
+            )
+            process.start()
+            child_connection.close()
+            self._connections.append(parent_connection)
+            self._processes.append(process)
+            self._locks.append(threading.Lock())
+
+        self._executor = ThreadPoolExecutor(max_workers=len(self.bounds))
+        self._pid = os.getpid()
+        atexit.register(self.close)
+        logger.info(f"[{len(self.bounds)}] shard workers started")
+
+    def _ensure_started(self) -> None:
+        if self._pid == os.getpid():
+            return
+
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._start()
+
+    def _local_ranges(self, shard: int, ranges: list | None) -> list | None:
+        if ranges is None:
+            return None
+
+        start, end = self.bounds[shard]
+
+        return [
+            (max(a, start) - start, min(b, end) - start)
+            for a, b in ranges
+            if a < end and b > start
+        ]
+
+    def _query_shard(self, shard: int, message: tuple) -> tuple:
+        with self._locks[shard]:
+            self._connections[shard].send(message)
+
+            return self._connections[shard].recv()
+
+    def _fan_out(
+        self, query_embedding: np.ndarray, top_k: int | None, ranges: list | None
+    ) -> list:
+        self._ensure_started()
+        query_embedding = helpers.normalize_rows(query_embedding)
+        futures = []
+
+        for shard in range(len(self.bounds)):
+            local_ranges = self._local_ranges(shard, ranges)
+
+            if local_ranges is not None and not local_ranges:
+                continue
+
+            futures.append(
+                self._executor.submit(
+                    self._query_shard, shard, (query_embedding, top_k, local_ranges)
+                )
+            )
+
+        # In shard order, which is the rows' order
+        return [future.result() for future in futures]
+
+    @helpers.measure_time(stage="scan")
+    def search(
+        self, query_embedding: np.ndarray, top_k: int, ranges: list | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the corpus rows of the best `top_k` matches and their scores,
+        optionally restricted to the given row ranges.
+        """
+        partial_results = self._fan_out(query_embedding, top_k, ranges)
+
+        if not partial_results:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+
+        rows = np.concatenate([rows for rows, _ in partial_results])
+        scores = np.concatenate([scores for _, scores in partial_results])
+        best = helpers.top_k_indices(scores, top_k)
+
+        return rows[best], scores[best]
+
+    def scores(self, query_embedding: np.ndarray, ranges: list | None = None):
+        """
+        Returns the score of every searched row, in row order, as
+        `Corpus.scores` does.
+        """
+        partial_scores = self._fan_out(query_embedding, None, ranges)
+
+        if not partial_scores:
+            return np.empty(0, dtype=np.float32)
+
+        return np.concatenate(partial_scores)
+
+    def close(self) -> None:
+        if self._pid != os.getpid():
+            return
+
+        for connection, lock in zip(self._connections, self._locks):
+            with lock:
+                try:
+                    connection.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+
+        for process in self._processes:
+            process.join(timeout=5)
+
+        self._executor.shutdown(wait=False)
+        self._pid = None
+        atexit.unregister(self.close)
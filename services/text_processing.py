@@ -8,67 +8,87 @@ from pypdf import PdfReader
 from sqlalchemy.orm import Session
 
 from models import crud
-from models import schema
 from utils import helpers
 from utils.logging import logger
 
 
+def _get_filename(pdf_path: str) -> str:
+    return os.path.splitext(os.path.basename(pdf_path))
+
+
+def _get_previous_versions(session: Session, filename: str) -> list[int]:
+    """
+    A known filename with a new hash is a revision of that document: its id
+    comes first, so it is updated in place and its texts are diffed instead of
+    re-embedded. The others are duplicates left active by older ingestions.
+    Nothing is changed here, process_data() applies the update once the new
+    chunks are embedded.
+    """
+    return [
+        document.id
+        for document in crud.get_active_documents_by_filename(session, filename)
+    ]
+
+
+def parse_pdf(
+    session: Session, pdf_path: str, file_hash: str | None = None
+) -> dict | None:
+    """
+    Registers a single PDF, returning the data to be embedded or None when the
+    file is already in the database.
+    """
+    file_hash = file_hash or helpers.generate_hash_from_file(pdf_path)
+    document = crud.get_document_by_hash(session, file_hash)
+
+    if document and len(document.texts) > 0:
+        logger.info(f"skipping [{pdf_path}] since it is already in the database")
+        return None
+
+    content = extract_text_from_pdf(pdf_path)
+    filename, _ = _get_filename(pdf_path)
+    document_id = document.id if document else None
+    outdated_document_ids = []
+
+    if document_id is None:
+        previous_document_ids = _get_previous_versions(session, filename)
+
+        if previous_document_ids:
+            document_id, *outdated_document_ids = previous_document_ids
+            logger.info(f"updating [{filename}] in place: [{document_id}]")
+
+    # New documents are only created by process_data(), along with their texts
+    return {
+        "filepath": pdf_path,
+        "filename": filename,
+        "name": filename,
+        "document_id": document_id,
+        "hash": file_hash,
+        "content": content,
+        "outdated_document_ids": outdated_document_ids,
+    }
+
+
 def parse_pdfs(
     session: Session, path: str = os.path.join(os.getcwd(), "data"), skip: int = 0
 ) -> dict:
-    existing_documents = {
-        document.hash: document for document in crud.get_all_documents(session)
-    }
     current_hashes = set()
     data = {}
 
-    def _get_filename(pdf_path: str) -> str:
-        return os.path.splitext(os.path.basename(pdf_path))
-
-    def _should_skip_file(file_hash: str, document: schema.Document) -> bool:
-        if file_hash in current_hashes:
-            logger.info(
-                f"skipping [{pdf_path}] ({file_hash}) as its' hash has already been processed"
-            )
-            return True
-
-        if document and len(document.texts) > 0:
-            logger.info(f"skipping [{pdf_path}] since it is already in the database")
-            return True
-
-        return False
-
-    def _process_pdf(pdf_path: str) -> tuple[dict, str]:
-        file_hash = helpers.generate_hash_from_file(pdf_path)
-        document = existing_documents.get(file_hash)
-
-        if _should_skip_file(file_hash=file_hash, document=document):
-            return None, None
-
-        content = extract_text_from_pdf(pdf_path)
-        filename, _ = _get_filename(pdf_path)
-
-        if not document:
-            document = crud.create_document(
-                session, pdf_path, filename, document_name=filename, content=content
-            )
-            logger.info(f"created new database entry for [{pdf_path}]: [{document.id}]")
-
-        return {
-            "filename": filename,
-            "name": filename,
-            "document_id": document.id,
-            "hash": file_hash,
-            "content": content,
-        }, file_hash
-
     for pdf_path in glob.glob(os.path.join(path, "*.pdf")):
         logger.info(f"processing: [{pdf_path}]")
 
         try:
-            entry, file_hash = _process_pdf(pdf_path)
+            file_hash = helpers.generate_hash_from_file(pdf_path)
+
+            if file_hash in current_hashes:
+                logger.info(
+                    f"skipping [{pdf_path}] ({file_hash}) as its' hash has already been processed"
+                )
+                continue
+
+            entry = parse_pdf(session, pdf_path, file_hash)
 
-            if entry and file_hash:
+            if entry:
                 data[entry.get("filename")] = entry
                 current_hashes.add(file_hash)
 
@@ -1,10 +1,29 @@
+import os
+
 CHUNK_SIZE = 512
+CHUNK_SECTION_CHARS = 20000  # Documents are chunked in sections of about this size
+CHUNK_WORKERS = min(4, os.cpu_count() or 1)  # Processes chunking large documents
+CHUNK_CACHE_DIR = os.path.join(os.getcwd(), ".chunks")
 
 DB_FILENAME = "documents.db"
 
-ENABLE_PERF_LOGGING = True
+ENABLE_PERF_LOGGING = False  # Per-call [PERF] log lines, for debugging only
+
+LOG_LEVEL = "DEBUG"
+LOG_FORMAT = "json"  # "json" or "default" (plain text)
+LOG_QUEUE_SIZE = 10000  # Records beyond this are dropped instead of blocking
+LOG_MAX_MESSAGE_CHARS = 2000
+LOG_PAYLOAD_SAMPLE_RATE = 0.1  # Fraction of the per-request payloads logged
+
+METRICS_ENABLED = True
+METRICS_SAMPLE_RATE = 1.0  # Fraction of the observations kept in the histograms
 
 BM25_SEARCH_WEIGHT = 0.2
+# "rank_bm25" (postings rebuilt in memory by every worker on each corpus reload)
+# or "fts5" (SQLite index, shared through the page cache)
+LEXICAL_BACKEND = "rank_bm25"
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"  # Case and accent insensitive
+FTS_CANDIDATES = 1000  # Lexical matches scored per query with the fts5 backend
 EMBEDDINGS_SEARCH_WEIGHT = 0.8
 
 CROSSENCODER_MODEL = "cross-encoder/ms-marco-TinyBERT-L-2-v2"
@@ -12,7 +31,51 @@ EMBEDDINGS_MODEL = "intfloat/multilingual-e5-small"  # "all-MiniLM-L6-v2"
 FAISS_DIMENSION = 384  # Property from the embedding model
 MIN_CHARS_PER_CHUNK = 128
 
-OLLAMA_ENDPOINT = "http://localhost:11434/api/generate"
+RERANK_CANDIDATES = 50  # First-stage pool handed to the cross-encoder
+RERANK_TOP_K = 5
+RERANK_THRESHOLD = -5.0
+RERANK_BATCH_SIZE = 16
+RERANK_PATIENCE = 1  # Batches without changes in the top-k before stopping
+RERANK_SCORE_GAP = 0.15  # Max first-stage score drop from the best candidate
+
+SEARCH_SHARDS = 1  # Above 1, vector search is spread over this many processes
+# Memory-mapped corpus snapshots, shared by every process through the page cache
+SNAPSHOT_DIR = os.path.join(os.getcwd(), ".snapshots")
+
+INGEST_DIR = os.path.join(os.getcwd(), "data")  # Only PDFs in here can be submitted
+INGEST_AT_STARTUP = True  # Enqueues the new PDFs found in INGEST_DIR on startup
+INGEST_WORKER_AUTOSTART = True  # Set to False by gunicorn, which starts it per worker
+INGEST_POLL_INTERVAL = 5.0  # Seconds between checks for new jobs and corpus versions
+INGEST_STALE_AFTER = 3600  # Seconds before a running job is considered abandoned
+
+SERVER_BIND = "0.0.0.0:5000"
+SERVER_WORKERS = 4
+SERVER_THREADS = 8  # Requests handled concurrently by each worker
+
+ADMISSION_MAX_IN_FLIGHT = 1  # Concurrent LLM calls per server worker
+ADMISSION_MAX_QUEUE = 8  # Requests waiting for an LLM slot, beyond that 429
+ADMISSION_QUEUE_TIMEOUT = 15.0  # Seconds waiting for a slot before giving up
+ADMISSION_SKIP_RERANK_WHEN_BUSY = True  # Skips the cross-encoder when requests wait
+ADMISSION_BUSY_QUEUE_DEPTH = 1  # Requests waiting for a slot that count as busy
+ADMISSION_RETRIEVAL_ONLY_FALLBACK = True  # Returns the sources instead of an error
+
+INFERENCE_BACKEND = "torch"  # "torch" or "onnx"
+INFERENCE_THREADS = max(1, (os.cpu_count() or 1) // SERVER_WORKERS)
+ONNX_CACHE_DIR = os.path.join(os.getcwd(), ".onnx")
+ONNX_QUANTIZE = True  # Dynamic int8 quantization of the exported models
+ONNX_QUANTIZATION_CONFIG = "avx2"  # "arm64", "avx2", "avx512" or "avx512_vnni"
+
+GENERATOR_TOKENIZER = "Qwen/Qwen2.5-3B-Instruct"  # Same tokenizer as OLLAMA_MODEL
+CONTEXT_RESERVED_TOKENS = 1024  # Kept free in num_ctx for the answer
+CONTEXT_MIN_RETRIEVAL_TOKENS = 1024  # Below this, the conversation context is dropped
+CONTEXT_DEDUP_THRESHOLD = 0.95  # Cosine similarity above which chunks are duplicates
+CONTEXT_CHARS_PER_TOKEN = 3.5  # Estimate used when the tokenizer is unavailable
+CONTEXT_TOKEN_CACHE_SIZE = 4096
+
+OLLAMA_ENDPOINT = os.environ.get(
+    "OLLAMA_ENDPOINT", "http://localhost:11434/api/generate"
+)
+OLLAMA_TIMEOUT = (3.05, 120)  # Connect and read timeouts, in seconds
 OLLAMA_MODEL = "qwen2.5:3b"
 OLLAMA_PARAMETERS = {
     "temperature": 0.70,
@@ -21,6 +84,12 @@ OLLAMA_PARAMETERS = {
     "top_p": 0.8,
     "mirostat": 2,
 }
+OLLAMA_KEEP_ALIVE = "30m"  # Keeps the model loaded between requests
+OLLAMA_RETURN_CONTEXT = True  # Returns Ollama's context so follow-ups can reuse it
+OLLAMA_INSTRUCTION_PREFIX = (
+    "Responda à pergunta ao final utilizando, quando relevantes, as informações "
+    "institucionais fornecidas como [CONTEXTO], indicando a fonte utilizada."
+)
 OLLAMA_SYSTEM_PROMPT = """
                         Você é um assistente acadêmico de informações da Univerdade Federal Rural do Semi-Árido (UFERSA). 
 
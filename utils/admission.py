@@ -0,0 +1,136 @@
+import math
+import threading
+import time
+
+from contextlib import contextmanager
+
+import settings
+
+
+class Rejected(Exception):
+    """
+    Raised when a request can't be admitted: `status` is 429 when the wait
+    queue is full and 503 when the wait deadline expired.
+    """
+
+    def __init__(self, status: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+    @property
+    def headers(self) -> dict:
+        return {"Retry-After": str(max(1, math.ceil(self.retry_after)))}
+
+
+class AdmissionController:
+    """
+    Limits the calls running at once to `max_in_flight`. Up to `max_queue`
+    callers wait for a slot, for at most `timeout` seconds; beyond that they
+    are rejected right away instead of piling up. The limits apply per process,
+    so under gunicorn the total is multiplied by the number of workers.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = settings.ADMISSION_MAX_IN_FLIGHT,
+        max_queue: int = settings.ADMISSION_MAX_QUEUE,
+        timeout: float = settings.ADMISSION_QUEUE_TIMEOUT,
+        busy_queue_depth: int = settings.ADMISSION_BUSY_QUEUE_DEPTH,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.busy_queue_depth = busy_queue_depth
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = {429: 0, 503: 0}
+        self._condition = threading.Condition()
+        self._average_duration = 0.0
+
+    @property
+    def busy(self) -> bool:
+        """
+        Whether at least `busy_queue_depth` requests wait for a slot, which is
+        when the optional stages (e.g. the rerank) are skipped. All slots
+        being taken isn't enough: with one slot, that is any second user.
+        """
+        return self.waiting >= max(1, self.busy_queue_depth)
+
+    def retry_after(self) -> float:
+        # Rough time for the queue ahead to drain
+        slots = max(1, self.max_in_flight)
+
+        return self._average_duration * (self.waiting + slots) / slots
+
+    def _reject(self, status: int, reason: str) -> Rejected:
+        self.rejected[status] += 1
+
+        return Rejected(status, reason, self.retry_after())
+
+    def check(self) -> None:
+        """
+        Rejects early, before any work is done for the request, when it would
+        be rejected anyway for lack of room in the wait queue.
+        """
+        with self._condition:
+            if self.in_flight >= self.max_in_flight and self.waiting >= self.max_queue:
+                raise self._reject(429, "too many requests waiting")
+
+    @contextmanager
+    def admit(self, timeout: float | None = None):
+        timeout = self.timeout if timeout is None else timeout
+
+        with self._condition:
+            if self.in_flight >= self.max_in_flight:
+                if self.waiting >= self.max_queue:
+                    raise self._reject(429, "too many requests waiting")
+
+                deadline = time.monotonic() + timeout
+                self.waiting += 1
+
+                try:
+                    while self.in_flight >= self.max_in_flight:
+                        remaining = deadline - time.monotonic()
+
+                        if remaining <= 0:
+                            raise self._reject(503, "timed out waiting for a slot")
+
+                        self._condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            self.in_flight += 1
+
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+
+            with self._condition:
+                self.in_flight -= 1
+                self._average_duration = 0.8 * self._average_duration + 0.2 * elapsed
+                self._condition.notify()
+
+    def render(self, name: str) -> str:
+        """
+        The current state in the Prometheus text format, as `name`-prefixed
+        gauges and counters.
+        """
+        with self._condition:
+            lines = [
+                f"# TYPE {name}_in_flight gauge",
+                f"{name}_in_flight {self.in_flight}",
+                f"# TYPE {name}_waiting gauge",
+                f"{name}_waiting {self.waiting}",
+                f"# TYPE {name}_rejected_total counter",
+            ]
+            lines.extend(
+                f'{name}_rejected_total{{status="{status}"}} {count}'
+                for status, count in self.rejected.items()
+            )
+
+        return "\n".join(lines) + "\n"
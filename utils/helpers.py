@@ -2,10 +2,11 @@ import numpy as np
 import hashlib
 import time
 
-from functools import wraps
+from functools import partial, wraps
 
 import settings
 
+from utils import metrics
 from utils.logging import logger
 
 
@@ -37,10 +38,37 @@ def normalize(x):
     return x
 
 
-def measure_time(func):
+def normalize_rows(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=-1, keepdims=True)
+    normalized = np.divide(x, norms, out=np.zeros_like(x), where=norms > 1e-6)
+
+    return normalized.astype(np.float32, copy=False)
+
+
+def top_k_indices(scores: np.ndarray, top_k: int) -> np.ndarray:
+    top_k = min(top_k, len(scores))
+
+    if top_k <= 0:
+        return np.empty(0, dtype=np.int64)
+
+    candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def measure_time(func=None, *, stage: str | None = None):
+    """
+    Records the call duration in the function histogram and, when `stage` is
+    given, in that stage's histogram and the current request's breakdown.
+    """
+    if func is None:
+        return partial(measure_time, stage=stage)
+
+    function_name = func.__qualname__
+
     @wraps(func)
     def wrapper(*args, **kwargs):
-        if not settings.ENABLE_PERF_LOGGING:
+        if not settings.ENABLE_PERF_LOGGING and not metrics.is_active():
             return func(*args, **kwargs)
 
         start_time = time.perf_counter()
@@ -48,7 +76,10 @@ def measure_time(func):
         end_time = time.perf_counter()
         elapsed = end_time - start_time
 
-        logger.info(f"[PERF] {func.__name__} took {elapsed:.6f} seconds")
+        metrics.observe(elapsed, stage=stage, function=function_name)
+
+        if settings.ENABLE_PERF_LOGGING:
+            logger.info(f"[PERF] {func.__name__} took {elapsed:.6f} seconds")
 
         return result
 
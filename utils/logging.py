@@ -1,5 +1,84 @@
+import atexit
+import json
 import logging
 import logging.config
+import logging.handlers
+import queue
+import random
+
+import settings
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "module": record.module,
+            "message": record.getMessage(),
+        }
+
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TruncatingFilter(logging.Filter):
+    def __init__(self, max_chars: int):
+        super().__init__()
+        self.max_chars = max_chars
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        message = record.getMessage()
+
+        if len(message) > self.max_chars:
+            record.msg = (
+                f"{message[: self.max_chars]}... "
+                f"[{len(message) - self.max_chars} chars truncated]"
+            )
+            record.args = None
+
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps only a fraction of the records logged with `extra={"sampled": True}`,
+    which is meant for the large, per-request payloads.
+    """
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if getattr(record, "sampled", False):
+            return random.random() < self.rate
+
+        return True
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands the records over to the writer thread as they are: the message is
+    only formatted there, and records are dropped instead of blocking the
+    caller when the queue is full.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
 
 LOGGING_CONFIG = {
     "version": 1,
@@ -7,7 +86,14 @@ LOGGING_CONFIG = {
     "formatters": {
         "default": {
             "format": "[%(asctime)s] %(levelname)8s @ %(module)12s: %(message)s"
-        }
+        },
+        "json": {"()": JSONFormatter},
+    },
+    "filters": {
+        "truncate": {
+            "()": TruncatingFilter,
+            "max_chars": settings.LOG_MAX_MESSAGE_CHARS,
+        },
     },
     "handlers": {
         "file": {
@@ -15,7 +101,8 @@ LOGGING_CONFIG = {
             "filename": "app.log",
             "when": "midnight",
             "backupCount": 30,
-            "formatter": "default",
+            "formatter": settings.LOG_FORMAT,
+            "filters": ["truncate"],
             "level": logging.DEBUG,
             "encoding": "utf-8",
         }
@@ -23,7 +110,7 @@ LOGGING_CONFIG = {
     "loggers": {
         "app": {
             "handlers": ["file"],
-            "level": logging.DEBUG,
+            "level": settings.LOG_LEVEL,
             "propagate": False,
         }
     },
@@ -31,3 +118,39 @@ LOGGING_CONFIG = {
 logging.config.dictConfig(LOGGING_CONFIG)
 
 logger = logging.getLogger("app")
+
+# The configured handlers are moved behind a queue and only used by the writer
+# thread, keeping the file I/O off the request path
+writer_handlers = logger.handlers[:]
+queue_handler = NonBlockingQueueHandler(queue.Queue(settings.LOG_QUEUE_SIZE))
+queue_handler.addFilter(SamplingFilter(settings.LOG_PAYLOAD_SAMPLE_RATE))
+logger.handlers = [queue_handler]
+
+listener = None
+
+
+def start_listener() -> None:
+    global listener
+
+    listener = logging.handlers.QueueListener(
+        queue_handler.queue, *writer_handlers, respect_handler_level=True
+    )
+    listener.start()
+
+
+def stop_listener() -> None:
+    if listener is not None:
+        listener.stop()
+
+
+def init_worker() -> None:
+    """
+    The writer thread doesn't survive a fork, so each worker starts its own on
+    a fresh queue (the inherited one may hold the master's locks).
+    """
+    queue_handler.queue = queue.Queue(settings.LOG_QUEUE_SIZE)
+    start_listener()
+
+
+start_listener()
+atexit.register(stop_listener)
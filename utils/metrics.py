@@ -0,0 +1,164 @@
+import random
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import settings
+
+
+BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+_request_timings: ContextVar[dict | None] = ContextVar("request_timings", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple = BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self) -> tuple[list[int], float, int]:
+        with self._lock:
+            return list(self.counts), self.sum, self.count
+
+
+class Registry:
+    """
+    In-process histograms, one per (family, label) pair. Under gunicorn each
+    worker keeps its own registry, so /metrics reports the serving worker only.
+    """
+
+    FAMILIES = {
+        "stage": "Time spent per pipeline stage, in seconds",
+        "function": "Time spent per instrumented function, in seconds",
+    }
+
+    def __init__(self):
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def histogram(self, family: str, label: str) -> Histogram:
+        histogram = self.histograms.get((family, label))
+
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault((family, label), Histogram())
+
+        return histogram
+
+    def render(self) -> str:
+        lines = []
+
+        for family, description in self.FAMILIES.items():
+            name = f"rag_{family}_duration_seconds"
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} histogram")
+
+            for (histogram_family, label), histogram in sorted(self.histograms.items()):
+                if histogram_family != family:
+                    continue
+
+                counts, total, count = histogram.snapshot()
+                cumulative = 0
+
+                for bucket, bucket_count in zip(histogram.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(
+                        f'{name}_bucket{{{family}="{label}",le="{bucket}"}} {cumulative}'
+                    )
+
+                lines.append(f'{name}_bucket{{{family}="{label}",le="+Inf"}} {count}')
+                lines.append(f'{name}_sum{{{family}="{label}"}} {total}')
+                lines.append(f'{name}_count{{{family}="{label}"}} {count}')
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def is_active() -> bool:
+    return settings.METRICS_ENABLED or _request_timings.get() is not None
+
+
+def observe(elapsed: float, stage: str | None = None, function: str | None = None):
+    if stage:
+        timings = _request_timings.get()
+
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+    if not settings.METRICS_ENABLED:
+        return
+
+    if (
+        settings.METRICS_SAMPLE_RATE < 1.0
+        and random.random() >= settings.METRICS_SAMPLE_RATE
+    ):
+        return
+
+    if stage:
+        registry.histogram("stage", stage).observe(elapsed)
+
+    if function:
+        registry.histogram("function", function).observe(elapsed)
+
+
+@contextmanager
+def timer(stage: str):
+    if not is_active():
+        yield
+        return
+
+    start_time = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        observe(time.perf_counter() - start_time, stage=stage)
+
+
+@contextmanager
+def request_timings():
+    """
+    Collects the per-stage breakdown of the current request into the yielded
+    dict, whatever the sampling rate.
+    """
+    timings = {}
+    token = _request_timings.set(timings)
+    start_time = time.perf_counter()
+
+    try:
+        yield timings
+    finally:
+        timings["total"] = time.perf_counter() - start_time
+        _request_timings.reset(token)